@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 # Needs freetype-py>=1.0
 
-# Implements multi-pass solution to setting an exact font height
+# Implements metric-driven solution to setting an exact font height
 
 # Some code adapted from Daniel Bader's work at the following URL
 # https://dbader.org/blog/monochrome-font-rendering-with-freetype-and-python
@@ -32,8 +32,14 @@
 # THE SOFTWARE.
 
 import argparse
+import ctypes
+import hashlib
+import json
+import struct
 import sys
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 try:
     import freetype
@@ -43,9 +49,19 @@ except ModuleNotFoundError:
 if freetype.version()[0] < 1:
     print("freetype version should be >= 1. Please see FONT_TO_PY.md")
 
+# NumPy is optional. If present it is used to speed up pixel handling.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 MINCHAR = 32  # Ordinal values of default printable ASCII set
 MAXCHAR = 126  # 94 chars
 
+# FreeType load flags for rendering glyphs and for obtaining metrics only.
+RENDER_FLAGS = freetype.FT_LOAD_RENDER | freetype.FT_LOAD_TARGET_MONO
+METRIC_FLAGS = freetype.FT_LOAD_TARGET_MONO
+
 # UTILITIES FOR WRITING PYTHON SOURCECODE TO A FILE
 
 # ByteWriter takes as input a variable name and data values and writes
@@ -54,6 +70,8 @@ MAXCHAR = 126  # 94 chars
 
 # Lines are broken with \ for readability.
 
+HEXBYTES = ["\\x{:02x}".format(byt) for byt in range(256)]  # Text of each byte value
+
 
 class ByteWriter:
     bytes_per_line = 16
@@ -82,10 +100,31 @@ class ByteWriter:
         if not self.bytecount:
             self._eol()
 
-    # Output from a sequence
+    # Output from a sequence. Whole lines are formatted at once and written in
+    # large chunks: the result is identical to calling .obyte for each byte.
     def odata(self, bytelist):
-        for byt in bytelist:
-            self.obyte(byt)
+        data = memoryview(bytes(bytelist))
+        bpl = self.bytes_per_line
+        lines = []
+        pos = 0
+        if self.bytecount:  # Complete a partial line
+            pos = min(len(data), bpl - self.bytecount)
+            lines.append("".join([HEXBYTES[byt] for byt in data[:pos]]))
+            self.bytecount = (self.bytecount + pos) % bpl
+            if not self.bytecount:
+                lines.append("'\\\n")
+        while len(data) - pos >= bpl:
+            lines.append(
+                "b'{}'\\\n".format("".join([HEXBYTES[byt] for byt in data[pos : pos + bpl]]))
+            )
+            pos += bpl
+            if len(lines) >= 4096:
+                self.stream.write("".join(lines))
+                lines.clear()
+        if pos < len(data):  # Start a partial line
+            lines.append("b'" + "".join([HEXBYTES[byt] for byt in data[pos:]]))
+            self.bytecount = len(data) - pos
+        self.stream.write("".join(lines))
 
     # ensure a correct final line
     def eot(self):  # User force EOL if one hasn't occurred
@@ -114,6 +153,26 @@ class Bitmap:
         self.height = height
         self.pixels = pixels or bytearray(width * height)
 
+    def crop(self):
+        """Return the left and top offsets and a bitmap of the ink box."""
+        pixels = self.pixels
+        width = self.width
+        rows = [row for row in range(self.height) if any(pixels[row * width : (row + 1) * width])]
+        if not rows:
+            return 0, 0, type(self)(0, 0)
+        cols = [col for col in range(width) if any(pixels[col::width])]
+        top, bottom = rows[0], rows[-1] + 1
+        left, right = cols[0], cols[-1] + 1
+        box = bytearray()
+        for row in range(top, bottom):
+            box += pixels[row * width + left : row * width + right]
+        return left, top, type(self)(right - left, bottom - top, box)
+
+    def extents(self):
+        """Return the first ink column and the column after the last."""
+        cols = [col for col in range(self.width) if any(self.pixels[col :: self.width])]
+        return (cols[0], cols[-1] + 1) if cols else (0, 0)
+
     def display(self):
         """Print the bitmap's pixels."""
         for row in range(self.height):
@@ -177,9 +236,169 @@ class Bitmap:
                 row += 1
 
 
+class NpBitmap(Bitmap):
+    """
+    A Bitmap whose pixels are processed as a 2D NumPy array. Output is
+    identical to that of the pure Python generators.
+    """
+
+    def array(self):
+        """Return a (height, width) uint8 array sharing the pixel buffer."""
+        return np.frombuffer(self.pixels, dtype=np.uint8).reshape(self.height, self.width)
+
+    def bitblt(self, src, top, left):
+        # A glyph which doesn't fit (e.g. wide glyph in a monospaced font) is
+        # handled by the base class which wraps excess pixels onto next row.
+        if top < 0 or left < 0 or top + src.height > self.height or left + src.width > self.width:
+            super().bitblt(src, top, left)
+            return
+        src_array = np.frombuffer(src.pixels, dtype=np.uint8).reshape(src.height, src.width)
+        self.array()[top : top + src.height, left : left + src.width] = src_array
+
+    def crop(self):
+        array = self.array()
+        rows = np.flatnonzero(array.any(axis=1))
+        if not rows.size:
+            return 0, 0, NpBitmap(0, 0)
+        cols = np.flatnonzero(array.any(axis=0))
+        box = array[rows[0] : rows[-1] + 1, cols[0] : cols[-1] + 1]
+        pixels = bytearray(box.tobytes())
+        return int(cols[0]), int(rows[0]), NpBitmap(box.shape[1], box.shape[0], pixels)
+
+    def extents(self):
+        cols = np.flatnonzero(self.array().any(axis=0))
+        return (int(cols[0]), int(cols[-1]) + 1) if cols.size else (0, 0)
+
+    # Rows are packed into bytes, zero padded on the right.
+    def get_hbyte(self, reverse):
+        bitorder = "little" if reverse else "big"
+        return np.packbits(self.array(), axis=1, bitorder=bitorder).tobytes()
+
+    # Columns are packed into bytes, zero padded at the bottom. Output is in
+    # column order hence the transposition.
+    def get_vbyte(self, reverse):
+        bitorder = "big" if reverse else "little"
+        return np.packbits(self.array(), axis=0, bitorder=bitorder).T.tobytes()
+
+
+# Translation tables between pixel bytes and the text of binary numbers.
+TO_BINARY = bytes([0x30] + [0x31] * 255)  # 0 -> "0", nonzero -> "1"
+FROM_BINARY = bytes(1 if byt == 0x31 else 0 for byt in range(256))  # "1" -> 1
+# Bit reversed value of each byte.
+REVERSED = bytes(int("{:08b}".format(byt)[::-1], 2) for byt in range(256))
+
+
+class PackedBitmap(Bitmap):
+    """
+    A Bitmap holding its pixels in a bytearray with one bit per pixel. Rows are
+    packed MSB first into (width + 7) // 8 bytes, zero padded on the right.
+    """
+
+    def __init__(self, width, height, pixels=None):
+        self.width = width
+        self.height = height
+        self.stride = stride = (width + 7) // 8
+        self.data = bytearray(stride * height)
+        if pixels and width:
+            pad = stride * 8 - width
+            for row in range(height):
+                text = pixels[row * width : (row + 1) * width].translate(TO_BINARY)
+                self.data[row * stride : (row + 1) * stride] = (int(text, 2) << pad).to_bytes(
+                    stride, "big"
+                )
+
+    @property
+    def pixels(self):
+        """The pixels as a bytearray with one byte per pixel."""
+        if not self.data:
+            return bytearray()
+        return unpack_rows(self.data, self.height, self.width, self.stride)
+
+    def rows(self):
+        """Return each row as an int, bit (stride * 8 - 1 - col) holding column col."""
+        stride = self.stride
+        data = self.data
+        return [int.from_bytes(data[n : n + stride], "big") for n in range(0, len(data), stride)]
+
+    def bitblt(self, src, top, left):
+        if top < 0 or left < 0 or top + src.height > self.height or left + src.width > self.width:
+            # Pixels which don't fit wrap onto the next row as in Bitmap.
+            unpacked = Bitmap(self.width, self.height, self.pixels)
+            unpacked.bitblt(Bitmap(src.width, src.height, src.pixels), top, left)
+            self.__init__(self.width, self.height, unpacked.pixels)
+            return
+        if not isinstance(src, PackedBitmap):
+            src = PackedBitmap(src.width, src.height, src.pixels)
+        stride = self.stride
+        shift = stride * 8 - left - src.width
+        mask = ~(((1 << src.width) - 1) << shift)
+        srcpad = src.stride * 8 - src.width
+        for row, value in enumerate(src.rows(), top):
+            start = row * stride
+            dst = int.from_bytes(self.data[start : start + stride], "big")
+            dst = (dst & mask) | (value >> srcpad << shift)
+            self.data[start : start + stride] = dst.to_bytes(stride, "big")
+
+    def extents(self):
+        ink = 0  # Bit (stride * 8 - 1 - col) is set if column col has ink
+        for value in self.rows():
+            ink |= value
+        if not ink:
+            return 0, 0
+        nbits = self.stride * 8
+        return nbits - ink.bit_length(), nbits - (ink & -ink).bit_length() + 1
+
+    def get_hbyte(self, reverse):
+        return self.data.translate(REVERSED) if reverse else bytes(self.data)
+
+    def get_vbyte(self, reverse):
+        rows = self.rows()
+        data = bytearray()
+        for col in range(self.width):
+            shift = self.stride * 8 - 1 - col
+            for start in range(0, self.height, 8):
+                byte = 0
+                for bit, value in enumerate(rows[start : start + 8]):
+                    byte |= ((value >> shift) & 1) << bit
+                data.append(byte)
+        return data.translate(REVERSED) if reverse else data
+
+
+# Pixel engine used for all glyph bitmaps.
+bitmap_class = Bitmap if np is None else NpBitmap
+
+
+def select_bitmap(packed):
+    """Choose packed bitmaps (less memory) or the fastest engine available."""
+    global bitmap_class
+    if packed:
+        bitmap_class = PackedBitmap
+    else:
+        bitmap_class = Bitmap if np is None else NpBitmap
+
+
+# Pixel values (one byte per pixel) of each possible packed byte, MSB first.
+UNPACKED = [bytes((byte >> (7 - bit)) & 1 for bit in range(8)) for byte in range(256)]
+
+
+def unpack_rows(src, rows, width, pitch):
+    """
+    Unpack a buffer of rows of MSB first packed pixels into a bytearray where
+    each pixel is represented by a single byte.
+    """
+    if np is not None:
+        packed = np.frombuffer(src, dtype=np.uint8).reshape(rows, pitch)
+        return bytearray(np.unpackbits(packed, axis=1)[:, :width].tobytes())
+    data = bytearray()
+    for row in range(rows):
+        start = row * pitch
+        data += b"".join([UNPACKED[byte] for byte in src[start : start + pitch]])[:width]
+    return data
+
+
 class Glyph:
     def __init__(self, pixels, width, height, top, left, advance_width):
-        self.bitmap = Bitmap(width, height, pixels)
+        self.bitmap = bitmap_class(width, height, pixels)
 
         # The glyph bitmap's top-side bearing, i.e. the vertical distance from
         # the baseline to the bitmap's top-most scanline.
@@ -218,14 +437,52 @@ class Glyph:
 
         return Glyph(pixels, width, height, top, left, advance_width)
 
+    # Glyphs are stored in the GlyphCache as a header followed by horizontally
+    # mapped rows. The advance width is held in 26.6 fixed point format.
+    HEADER = struct.Struct("<HHiii")
+
+    def to_bytes(self):
+        header = Glyph.HEADER.pack(
+            self.width, self.height, self.top, self.left, int(self.advance_width * 64)
+        )
+        return header + bytes(self.bitmap.get_hbyte(False))
+
+    @staticmethod
+    def from_bytes(data):
+        width, height, top, left, advance = Glyph.HEADER.unpack_from(data)
+        pixels = bytearray()
+        if width and height:
+            src = memoryview(data)[Glyph.HEADER.size :]
+            pixels = unpack_rows(src, height, width, (width - 1) // 8 + 1)
+        return Glyph(pixels, width, height, top, left, advance / 64)
+
     @staticmethod
     def unpack_mono_bitmap(bitmap):
         """
         Unpack a freetype FT_LOAD_TARGET_MONO glyph bitmap into a bytearray
         where each pixel is represented by a single byte.
         """
+        rows, width, pitch = bitmap.rows, bitmap.width, bitmap.pitch
+        if not (rows and width):
+            return bytearray()
+        ft_bitmap = getattr(bitmap, "_FT_Bitmap", None)
+        if ft_bitmap is None or pitch <= 0:
+            return Glyph._unpack_mono_slow(bitmap)
+        # bitmap.buffer builds a list from the C buffer each time it is read,
+        # so view the FT_Bitmap memory directly. Valid until the next glyph load.
+        address = ctypes.addressof(ft_bitmap.buffer.contents)
+        src = memoryview((ctypes.c_ubyte * (rows * pitch)).from_address(address)).cast("B")
+        return unpack_rows(src, rows, width, pitch)
+
+    @staticmethod
+    def _unpack_mono_slow(bitmap):
+        """
+        Unpack a glyph bitmap one pixel at a time using the freetype-py buffer
+        property. Used where the FT_Bitmap memory can't be accessed directly.
+        """
         # Allocate a bytearray of sufficient size to hold the glyph bitmap.
         data = bytearray(bitmap.rows * bitmap.width)
+        buffer = bitmap.buffer  # Property creates a list: read it once.
 
         # Iterate over every byte in the glyph bitmap. Note that we're not
         # iterating over every pixel in the resulting unpacked bitmap --
@@ -234,7 +491,7 @@ class Glyph:
             for byte_index in range(bitmap.pitch):
 
                 # Read the byte that contains the packed pixel data.
-                byte_value = bitmap.buffer[row * bitmap.pitch + byte_index]
+                byte_value = buffer[row * bitmap.pitch + byte_index]
 
                 # We've processed this many bits (=pixels) so far. This
                 # determines where we'll read the next batch of pixels from.
@@ -262,6 +519,137 @@ class Glyph:
         return data
 
 
+# GLYPH CACHE
+# Glyph data may be saved in a directory for reuse by later runs. Each file is
+# named by a hash of the font file contents, the pixel size, the FreeType load
+# flags and the FreeType version, and holds data for each char at that size.
+# File contents: magic, then for each char ordinal (4 bytes), length of data
+# (2 bytes), data.
+
+
+# Metrics stored for sizing: horiBearingY and height in 26.6 format.
+METRICS = struct.Struct("<ii")
+
+
+class GlyphCache:
+    MAGIC = b"FGC1"
+    RECORD = struct.Struct("<IH")
+
+    def __init__(self, directory, font_path, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        with open(font_path, "rb") as f:
+            self._font_hash = hashlib.sha256(f.read()).hexdigest()
+        self._entries = {}  # dicts of data keyed by char, keyed by filename
+        self._loaded = {}  # Number of chars read from each file
+        self.hits = 0
+        self.misses = 0
+
+    def _filename(self, size, flags):
+        key = "{} {} {} {}".format(self._font_hash, size, flags, freetype.version())
+        name = hashlib.sha256(key.encode()).hexdigest()[:32] + ".fgc"
+        return os.path.join(self.directory, name)
+
+    # Return a dict of data keyed by char for a given size and load flags.
+    # Data added to the dict is saved by .flush().
+    def entries(self, size, flags):
+        filename = self._filename(size, flags)
+        if filename not in self._entries:
+            self._entries[filename] = entries = {}
+            try:
+                with open(filename, "rb") as f:
+                    data = f.read()
+                os.utime(filename)  # Most recently used
+            except OSError:
+                data = b""
+            if data[:4] == GlyphCache.MAGIC:
+                offs = 4
+                while offs < len(data):
+                    ordv, length = GlyphCache.RECORD.unpack_from(data, offs)
+                    offs += GlyphCache.RECORD.size
+                    entries[chr(ordv)] = data[offs : offs + length]
+                    offs += length
+            self._loaded[filename] = len(entries)
+        return self._entries[filename]
+
+    # Write new data to disk, then evict least recently used files until the
+    # cache is within its size limit.
+    def flush(self):
+        os.makedirs(self.directory, exist_ok=True)
+        for filename, entries in self._entries.items():
+            if len(entries) == self._loaded[filename]:
+                continue
+            data = bytearray(GlyphCache.MAGIC)
+            for char, value in entries.items():
+                data += GlyphCache.RECORD.pack(ord(char), len(value))
+                data += value
+            tmpname = "{}.{}.tmp".format(filename, os.getpid())
+            with open(tmpname, "wb") as f:
+                f.write(data)
+            os.replace(tmpname, filename)  # Atomic: concurrent runs may share a cache
+            self._loaded[filename] = len(entries)
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".fgc"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(f[1] for f in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+# PARALLEL RENDERING
+# Each worker process opens its own Face. A size of None is used for bitmapped
+# fonts which are rendered at their native size.
+_worker_face = None
+
+
+def _init_worker(filename, bitmap):
+    global _worker_face, bitmap_class
+    _worker_face = freetype.Face(filename)
+    bitmap_class = bitmap  # As selected in the parent process
+
+
+def _render_chunk(size, chars):
+    if size is not None:
+        _worker_face.set_pixel_sizes(0, size)
+    glyphs = []
+    for char in chars:
+        _worker_face.load_char(char, RENDER_FLAGS)
+        glyphs.append(Glyph.from_glyphslot(_worker_face.glyph))
+    return glyphs
+
+
+STREAM_CHUNK = 1024  # Chars rendered at a time when streaming
+
+# Faces are shared by Font instances so that each font file is opened only
+# once in a batch run. Each Font sets the pixel size it requires.
+_faces = {}
+
+
+def get_face(filename):
+    if filename not in _faces:
+        _faces[filename] = freetype.Face(filename)
+    return _faces[filename]
+
+
+_charsets = {}  # Resolved charsets keyed by font file, default char and charset
+_supported = {}  # Set of chars supported by each font file
+
+
+# Return the set of chars having glyphs in a font file's charmap.
+def get_supported(filename):
+    if filename not in _supported:
+        _supported[filename] = {chr(code) for code, _ in get_face(filename).get_chars()}
+    return _supported[filename]
+
+
 # A Font object is a dictionary of ASCII chars indexed by a character e.g.
 # myfont['a']
 # Each entry comprises a list
@@ -271,9 +659,33 @@ class Glyph:
 # height (in pixels) of all characters
 # width (in pixels) for monospaced output (advance width of widest char)
 class Font(dict):
-    def __init__(self, filename, size, minchar, maxchar, monospaced, defchar, charset, bitmapped):
+    def __init__(
+        self,
+        filename,
+        size,
+        minchar,
+        maxchar,
+        monospaced,
+        defchar,
+        charset,
+        bitmapped,
+        jobs=1,
+        cache=None,
+        stream=False,
+    ):
         super().__init__()
-        self._face = freetype.Face(filename)
+        self._face = get_face(filename)
+        self._size = None  # Pixel size currently set on the face
+        self._jobs = jobs
+        # If streaming, glyphs are rendered when needed and then discarded.
+        # Values remain None and .close() must be called after output.
+        self._stream = stream
+        self._cache = cache  # GlyphCache instance or None
+        if cache is not None:
+            cache.hits = cache.misses = 0
+        self._executor = None
+        self._glyphs = {}  # Glyphs rendered at pixel size ._glyph_size keyed by char
+        self._glyph_size = None
         # .crange is the inclusive range of ordinal values spanning the character set.
         self.crange = range(minchar, maxchar + 1)
         self.monospaced = monospaced
@@ -286,39 +698,100 @@ class Font(dict):
         elif charset == "":
             self.charset = [chr(defchar)] + [chr(ordv) for ordv in self.crange]
         else:
-            cl = [ord(x) for x in chr(defchar) + charset if self._face.get_char_index(x) != 0]
-            self.crange = range(min(cl), max(cl) + 1)  # Inclusive ordinal value range
-            cs = [
-                chr(ordv)
-                if chr(ordv) in charset and self._face.get_char_index(chr(ordv)) != 0
-                else ""
-                for ordv in self.crange
-            ]
-            # .charset has an item for all chars in range. '' if unsupported.
-            # item 0 is the default char. Subsequent chars are in increasing ordinal value.
-            self.charset = [chr(defchar)] + cs
+            self.crange, self.charset = self._resolve_charset(filename, defchar, charset)
         # Populate self with defined chars only
         self.update(dict.fromkeys([c for c in self.charset if c]))
-        self.max_width = self.bmp_dimensions(size) if bitmapped else self.get_dimensions(size)
-        self.width = self.max_width if monospaced else 0
-        self._assign_values()  # Assign values to existing keys
+        # Requested chars for which the font has no glyph.
+        requested = charset if charset else (c for c in self.charset if c)
+        supported = get_supported(filename)
+        self.missing = sorted({c for c in requested if c not in supported})
+        if jobs > 1:
+            self._executor = ProcessPoolExecutor(
+                jobs, initializer=_init_worker, initargs=(filename, bitmap_class)
+            )
+        try:
+            self.max_width = self.bmp_dimensions(size) if bitmapped else self.get_dimensions(size)
+            self.width = self.max_width if monospaced else 0
+            if not stream:
+                self._assign_values()  # Assign values to existing keys
+        except BaseException:
+            self.close()
+            raise
+        if not stream:
+            self.close()
+
+    # Release resources used in rendering glyphs.
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        self._glyphs.clear()
+        if self._cache is not None:
+            self._cache.flush()
+            st = "Glyph cache: {} hits {} misses."
+            print(st.format(self._cache.hits, self._cache.misses))
+            self._cache = None
+
+    # Find the chars in a charset supported by the face. Results are reused by
+    # later conversions of the same font in a batch run.
+    def _resolve_charset(self, filename, defchar, charset):
+        key = (filename, defchar, charset)
+        if key not in _charsets:
+            supported = get_supported(filename)
+            chars = set(charset) & supported
+            cl = {ord(x) for x in chars}
+            if chr(defchar) in supported:
+                cl.add(defchar)
+            crange = range(min(cl), max(cl) + 1)  # Inclusive ordinal value range
+            cs = [chr(ordv) if chr(ordv) in chars else "" for ordv in crange]
+            # .charset has an item for all chars in range. '' if unsupported.
+            # item 0 is the default char. Subsequent chars are in increasing ordinal value.
+            _charsets[key] = crange, [chr(defchar)] + cs
+        return _charsets[key]
 
-    def bmp_dimensions(self, height):
+    # Render the charset at the current size. Return the maximum ascent,
+    # descent and width of its glyphs.
+    def _measure(self):
+        max_ascent = 0
         max_descent = 0
-        # For each character in the charset string we get the glyph
-        # and update the overall dimensions of the resulting bitmap.
         max_width = 0
-        max_ascent = 0
-        for char in self.keys():
-            glyph = self._glyph_for_character(char)
+        for glyph in self._iter_glyphs(list(self.keys())):
             max_ascent = max(max_ascent, glyph.ascent)
             max_descent = max(max_descent, glyph.descent)
             # for a few chars e.g. _ glyph.width > glyph.advance_width
             max_width = int(max(max_width, glyph.advance_width, glyph.width))
+        return int(max_ascent), int(max_descent), max_width
+
+    def _set_size(self, size):
+        self._face.set_pixel_sizes(0, size)
+        self._size = size
+
+    # Estimate the height of the charset at a given size from glyph metrics.
+    # Glyphs are loaded (and hinted) but not rendered so this is cheap. The
+    # estimate can differ from the rendered height by a pixel or two.
+    def _metric_height(self, size):
+        self._set_size(size)
+        cached = {} if self._cache is None else self._cache.entries(size, METRIC_FLAGS)
+        max_ascent = 0
+        max_descent = 0
+        for char in self.keys():
+            if char in cached:
+                bearing_y, height = METRICS.unpack(cached[char])
+            else:
+                self._face.load_char(char, METRIC_FLAGS)
+                metrics = self._face.glyph.metrics
+                bearing_y, height = metrics.horiBearingY, metrics.height
+                cached[char] = METRICS.pack(bearing_y, height)
+            top = -(-bearing_y // 64)
+            rows = top - (bearing_y - height) // 64
+            descent = max(0, rows - top)  # As calculated by Glyph
+            max_ascent = max(max_ascent, max(top, rows) - descent)
+            max_descent = max(max_descent, descent)
+        return max_ascent + max_descent
 
-        self.height = int(max_ascent + max_descent)
-        self._max_ascent = int(max_ascent)
-        self._max_descent = int(max_descent)
+    def bmp_dimensions(self, height):
+        self._max_ascent, self._max_descent, max_width = self._measure()
+        self.height = self._max_ascent + self._max_descent
         print("Requested height", height)
         print("Actual height", self.height)
         print("Max width", max_width)
@@ -326,123 +799,571 @@ class Font(dict):
         print("Max ascent", self._max_ascent)
         return max_width
 
-    # n-pass solution to setting a precise height.
+    # Find the pixel size giving a precise height. Searching outwards from
+    # the requested size, glyph metrics are used to find the nearest size whose
+    # estimated height matches the requirement. The estimate is then corrected
+    # by rendering, bracketed by sizes known to be too small and too large.
+    # Where several sizes give the required height the one nearest to it is
+    # used. If no size gives it the nearest height is used, the smaller where
+    # two are equally near.
     def get_dimensions(self, required_height):
-        error = 0
-        height = required_height
-        for npass in range(10):
-            height += error
-            self._face.set_pixel_sizes(0, height)
-            max_descent = 0
-
-            # For each character in the charset string we get the glyph
-            # and update the overall dimensions of the resulting bitmap.
-            max_width = 0
-            max_ascent = 0
-            for char in self.keys():
-                glyph = self._glyph_for_character(char)
-                max_ascent = max(max_ascent, glyph.ascent)
-                max_descent = max(max_descent, glyph.descent)
-                # for a few chars e.g. _ glyph.width > glyph.advance_width
-                max_width = int(max(max_width, glyph.advance_width, glyph.width))
-
-            new_error = required_height - (max_ascent + max_descent)
-            if (new_error == 0) or (abs(new_error) - abs(error) == 0):
+        metric = {}  # Estimated height for each size tried
+
+        def estimate(size):
+            if size not in metric:
+                metric[size] = self._metric_height(size)
+            return metric[size]
+
+        # Bisect between a size lo where test fails and hi where it succeeds.
+        def boundary(lo, hi, test):
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if test(mid):
+                    hi = mid
+                else:
+                    lo = mid
+            return lo, hi
+
+        size = required_height
+        if estimate(size) > required_height:  # Largest smaller size which fits
+            lo = size
+            while lo > 1 and estimate(lo) > required_height:
+                lo //= 2
+            if estimate(lo) <= required_height:
+                size, _ = boundary(lo, size, lambda s: estimate(s) > required_height)
+            else:
+                size = lo
+        elif estimate(size) < required_height:  # Smallest larger size which fits
+            hi = size
+            while hi < 64 * required_height and estimate(hi) < required_height:
+                hi *= 2
+            if estimate(hi) >= required_height:
+                _, size = boundary(size, hi, lambda s: estimate(s) >= required_height)
+            else:
+                size = hi
+
+        below = 0  # Largest size known to be too small
+        above = None  # Smallest size known to be too large
+        heights = {}  # Rendered height for each size tried
+        while True:
+            self._set_size(size)
+            max_ascent, max_descent, max_width = self._measure()
+            heights[size] = max_ascent + max_descent
+            error = required_height - heights[size]
+            if error == 0:  # Step towards size == height while the height is unchanged
+                step = 1 if size < required_height else -1
+                while size != required_height:
+                    nearer = size + step
+                    if nearer <= below or (above is not None and nearer >= above):
+                        break
+                    self._set_size(nearer)
+                    measured = self._measure()
+                    heights[nearer] = measured[0] + measured[1]
+                    if heights[nearer] != required_height:
+                        break
+                    size = nearer
+                    max_ascent, max_descent, max_width = measured
+                self._set_size(size)
+                break
+            if error > 0:
+                below = max(below, size)
+            else:
+                above = size if above is None else min(above, size)
+            size += error
+            if size <= below or (above is not None and size >= above):
+                size = below + 1 if above is None else (below + above) // 2
+            if size <= below:  # No size between below and above
+                size = min(
+                    (s for s in (below, above) if s in heights),
+                    key=lambda s: (abs(required_height - heights[s]), heights[s]),
+                )
+                print("Requested height {} pixels is unreachable.".format(required_height))
+                self._set_size(size)
+                max_ascent, max_descent, max_width = self._measure()
                 break
-            error = new_error
-        self.height = int(max_ascent + max_descent)
-        st = "Height set in {} passes. Actual height {} pixels.\nMax character width {} pixels."
-        print(st.format(npass + 1, self.height, max_width))
-        self._max_ascent = int(max_ascent)
-        self._max_descent = int(max_descent)
+
+        self.height = max_ascent + max_descent
+        st = "Height set in {} metric and {} render passes. Actual height {} pixels."
+        print(st.format(len(metric), len(heights), self.height))
+        print("Max character width {} pixels.".format(max_width))
+        self._max_ascent = max_ascent
+        self._max_descent = max_descent
         return max_width
 
     def _glyph_for_character(self, char):
         # Let FreeType load the glyph for the given character and tell it to
         # render a monochromatic bitmap representation.
         assert char != ""
-        self._face.load_char(char, freetype.FT_LOAD_RENDER | freetype.FT_LOAD_TARGET_MONO)
+        self._face.load_char(char, RENDER_FLAGS)
         return Glyph.from_glyphslot(self._face.glyph)
 
-    def _assign_values(self):
-        for char in self.keys():
-            glyph = self._glyph_for_character(char)
-            # https://github.com/peterhinch/micropython-font-to-py/issues/21
-            # Handle negative glyph.left correctly (capital J),
-            # also glyph.width > advance (capital K and R).
-            if glyph.left >= 0:
-                char_width = int(max(glyph.advance_width, glyph.width + glyph.left))
-                left = glyph.left
-            else:
-                char_width = int(max(glyph.advance_width - glyph.left, glyph.width))
-                left = 0
+    # Yield a Glyph for each char in a list. If streaming, glyphs are rendered
+    # a chunk at a time to limit memory use.
+    def _iter_glyphs(self, chars):
+        if not self._stream:
+            yield from self._render_glyphs(chars)
+            return
+        for n in range(0, len(chars), STREAM_CHUNK):
+            yield from self._render_glyphs(chars[n : n + STREAM_CHUNK])
+
+    # Return a Glyph for each char in a list, in the same order. Unless
+    # streaming, glyphs are cached so each char is rendered only once at the
+    # current size. Glyphs of other sizes are discarded. With a process pool the
+    # chars are rendered in contiguous chunks by the workers.
+    def _render_glyphs(self, chars):
+        size = self._size
+        required = chars
+        if self._stream or size != self._glyph_size:
+            self._glyphs.clear()  # Only the current chunk or size is retained
+            self._glyph_size = size
+        chars = [char for char in dict.fromkeys(chars) if char not in self._glyphs]
+        if self._cache is not None and chars:
+            cached = self._cache.entries(size, RENDER_FLAGS)
+            for char in chars:
+                if char in cached:
+                    self._glyphs[char] = Glyph.from_bytes(cached[char])
+            nchars = len(chars)
+            chars = [char for char in chars if char not in cached]
+            self._cache.hits += nchars - len(chars)
+            self._cache.misses += len(chars)
+        if self._executor is None:
+            glyphs = [self._glyph_for_character(char) for char in chars]
+        elif chars:
+            chunksize = -(-len(chars) // (self._jobs * 4))
+            chunks = [chars[n : n + chunksize] for n in range(0, len(chars), chunksize)]
+            glyphs = []
+            for chunk in self._executor.map(_render_chunk, [size] * len(chunks), chunks):
+                glyphs.extend(chunk)
+        else:
+            glyphs = []
+        self._glyphs.update(zip(chars, glyphs))
+        if self._cache is not None:
+            cached = self._cache.entries(size, RENDER_FLAGS)
+            cached.update((char, glyph.to_bytes()) for char, glyph in zip(chars, glyphs))
+        return [self._glyphs[char] for char in required]
+
+    # Return the value for a char given its Glyph: a list comprising a Bitmap
+    # padded to the font height and the width, also the glyph's own width.
+    def _char_values(self, glyph):
+        # https://github.com/peterhinch/micropython-font-to-py/issues/21
+        # Handle negative glyph.left correctly (capital J),
+        # also glyph.width > advance (capital K and R).
+        if glyph.left >= 0:
+            char_width = int(max(glyph.advance_width, glyph.width + glyph.left))
+            left = glyph.left
+        else:
+            char_width = int(max(glyph.advance_width - glyph.left, glyph.width))
+            left = 0
 
-            width = self.width if self.width else char_width  # Space required if monospaced
-            outbuffer = Bitmap(width, self.height)
+        width = self.width if self.width else char_width  # Space required if monospaced
+        outbuffer = bitmap_class(width, self.height)
 
-            # The vertical drawing position should place the glyph
-            # on the baseline as intended.
-            row = self.height - int(glyph.ascent) - self._max_descent
-            outbuffer.bitblt(glyph.bitmap, row, left)
-            self[char] = [outbuffer, width, char_width]
+        # The vertical drawing position should place the glyph
+        # on the baseline as intended.
+        row = self.height - int(glyph.ascent) - self._max_descent
+        outbuffer.bitblt(glyph.bitmap, row, left)
+        return [outbuffer, width, char_width]
 
-    def stream_char(self, char, hmap, reverse):
-        outbuffer, _, _ = self[char]
-        if hmap:
-            gen = outbuffer.get_hbyte(reverse)
+    def _assign_values(self):
+        chars = list(self.keys())
+        for char, glyph in zip(chars, self._iter_glyphs(chars)):
+            self[char] = self._char_values(glyph)
+
+    # Yield the values of each char in a list, rendering them if streaming.
+    def _iter_values(self, chars):
+        if not self._stream:
+            for char in chars:
+                yield self[char]
         else:
-            gen = outbuffer.get_vbyte(reverse)
-        yield from gen
+            for glyph in self._iter_glyphs(chars):
+                yield self._char_values(glyph)
+
+    @staticmethod
+    def _pack(outbuffer, hmap, reverse):
+        if hmap:
+            return outbuffer.get_hbyte(reverse)
+        return outbuffer.get_vbyte(reverse)
+
+    # Return an iterable of bytes for the char
+    def stream_char(self, char, hmap, reverse):
+        outbuffer, _, _ = next(self._iter_values([char]))
+        return Font._pack(outbuffer, hmap, reverse)
 
-    def build_arrays(self, hmap, reverse):
+    # Row-RLE encoding of a glyph comprising rows (or columns if vertically
+    # mapped) of stride bytes. Each op byte n is followed by n literal rows or,
+    # if bit 7 is set, repeats the prior row n & 0x7F times. The row preceding
+    # the glyph is blank.
+    @staticmethod
+    def _compress(data, stride):
+        rows = [bytes(data[n : n + stride]) for n in range(0, len(data), stride or 1)]
+        result = bytearray()
+        prev = bytes(stride)
+        n = 0
+        while n < len(rows):
+            start = n
+            while n < len(rows) and n - start < 0x7F and rows[n] == prev:
+                n += 1
+            if n > start:  # Repeat
+                result.append(0x80 | (n - start))
+                continue
+            while n < len(rows) and n - start < 0x7F and rows[n] != prev:
+                prev = rows[n]
+                n += 1
+            result.append(n - start)  # Literal
+            for row in rows[start:n]:
+                result += row
+        return result
+
+    # Glyph data is produced in order of output. If a function out is passed,
+    # data is passed to it as it is produced rather than being returned.
+    # If compress is True glyphs are row-RLE encoded. If crop is True glyphs
+    # are cropped to their ink box. self.sizes holds the raw and stored sizes
+    # of glyph bitmaps and the size of the largest raw bitmap.
+    # Identical glyphs are stored once: self.duplicates holds the number of
+    # glyphs and bytes saved.
+    # layout is the index type: "normal", "sparse", "paged", "range", "hybrid"
+    # or "auto" to choose based on the charset. self.index_type holds the type used.
+    # Normal fonts return the index, sparse fonts the sparse index, paged and
+    # range fonts the page or range table and the offsets (see paged_index()
+    # and range_index()).
+    # If large is True index fields are 3 bytes. Otherwise they are 2 bytes
+    # unless ordinal values exceed 0xFFFF, and OverflowError is raised if glyph
+    # data is too big for the index.
+    # A hybrid index has a dense index of the inclusive range of ordinal values
+    # dense and a sparse index of other chars. These are returned as index and
+    # sparse.
+    def build_arrays(
+        self,
+        hmap,
+        reverse,
+        out=None,
+        compress=False,
+        crop=False,
+        layout="auto",
+        large=False,
+        dense=(MINCHAR, MAXCHAR),
+    ):
         data = bytearray()
         index = bytearray()
         sparse = bytearray()
-
-        def append_data(data, char):
-            width = self[char][1]
-            data += (width).to_bytes(2, byteorder="little")
-            data += bytearray(self.stream_char(char, hmap, reverse))
+        offset = 0  # Length of glyph data produced
+        raw = 0
+        stored = 0
+        largest = 0
+        records = Records()
+        # Ink extents (1 byte each) follow the bitmap of uncropped glyphs. They
+        # precede compressed glyphs so are always present, 0 for wide fonts.
+        ink = self.max_width < 256
+        fixed = False  # Fixed stride records have no width field
+
+        def emit(buf):
+            nonlocal offset
+            offset += len(buf)
+            if out is None:
+                data.extend(buf)
+            else:
+                out(buf)
+
+        # Return the offset of a glyph record, emitting it unless an identical
+        # record exists and share is set. New records start at a multiple of
+        # align bytes.
+        def append_data(values, align=1, share=True):
+            nonlocal raw, stored, largest
+            outbuffer, width, _ = values
+            record = b"" if fixed else (width).to_bytes(2, byteorder="little")
+            if crop:
+                length = len(bytes(Font._pack(outbuffer, hmap, reverse)))
+                left, top, outbuffer = outbuffer.crop()
+                box = (left, top, outbuffer.width, outbuffer.height)
+                if max(box) > 255:
+                    raise ValueError("Cropped glyphs must be < 256 pixels high and wide.")
+                record += bytes(box)
+            glyph = bytes(Font._pack(outbuffer, hmap, reverse))
+            if not crop:
+                length = len(glyph)
+            largest = max(largest, length)
+            if compress:
+                stride = (width - 1) // 8 + 1 if hmap else (self.height - 1) // 8 + 1
+                glyph = Font._compress(glyph, stride)
+                record += bytes(outbuffer.extents() if ink else 2)
+            record += glyph
+            if ink and not (crop or compress):
+                record += bytes(outbuffer.extents())
+            start = records.find(record) if share else None
+            if start is None:
+                pad = offset % align
+                if pad:
+                    emit(bytearray(align - pad))
+                start = records.add(record, offset)
+                emit(record)
+                raw += length
+                stored += len(glyph)
+            return start
 
         # self.charset is contiguous with chars having ordinal values in the
         # inclusive range specified. Where the specified character set has gaps
         # missing characters are empty strings.
-        # Charset includes default char and both max and min chars, hence +2.
-        if len(self.charset) <= MAXCHAR - MINCHAR + 2:
+        chars = sorted(self.keys())
+        first, last = dense
+        others = [char for char in chars if not first <= ord(char) <= last]
+        # Large fonts have 3 byte fields in the index, otherwise 2. Glyph offsets
+        # in sparse indices of normal fonts are divided by 8.
+        if chars and ord(chars[-1]) > 0xFFFF and layout != "normal":
+            large = True
+        size = 3 if large else 2
+        shift = 0 if large else 3
+        self.large = large
+        # Fixed stride layout: size of the map of ordinal values onto slots. The
+        # map is omitted where slots can be allocated in charset order.
+        dense_map = size * (len(self.charset) - 1)
+        slot_map = 0
+        if "" in self.charset or self.missing:
+            slot_map = min(dense_map, 2 * size * len(chars))
+        self.index_type = layout
+        if layout == "auto":
+            sizes = {"sparse": 2 * size * len(chars), "range": range_size(chars, size)}
+            # Charset includes default char and both max and min chars, hence +2.
+            if len(self.charset) <= MAXCHAR - MINCHAR + 2:
+                self.index_type = "normal"
+                sizes["normal"] = size * (len(self.charset) + 1)
+            else:  # Choose the smallest index
+                sizes["hybrid"] = size * (last - first + 1) + 2 * size * len(others)
+                npages = len({ord(char) >> 8 for char in chars})
+                if npages < 256 and ord(chars[-1]) <= 0xFFFF:
+                    sizes["paged"] = paged_size(npages, len(chars), size)
+                self.index_type = min(sizes, key=sizes.get)
+            # A fixed stride saves the width field of each glyph.
+            if self.monospaced and not (compress or crop):
+                if slot_map <= sizes[self.index_type] + 2 * len(chars):
+                    self.index_type = "fixed"
+        elif layout == "paged" and chars and ord(chars[-1]) > 0xFFFF:
+            raise ValueError("Paged index requires ordinal values < 0x10000.")
+        elif layout == "paged" and len({ord(char) >> 8 for char in chars}) > 255:
+            raise ValueError("Paged index supports at most 255 pages.")
+        elif layout == "fixed" and (not self.monospaced or compress or crop):
+            raise ValueError("Fixed stride layout requires an uncompressed monospaced font.")
+        fixed = self.index_type == "fixed"
+        if fixed:
+            # Glyph n starts at n * stride. If there is no slot map, slot n holds
+            # charset[n] and records are not shared. Otherwise index or sparse
+            # maps ordinal values onto slots.
+            if hmap:
+                stride = ((self.max_width - 1) // 8 + 1) * self.height
+            else:
+                stride = ((self.height - 1) // 8 + 1) * self.max_width
+            stride += 2 if ink else 0
+            self.stride = stride
+            if not slot_map:
+                for values in self._iter_values(self.charset):
+                    append_data(values, share=False)
+            else:
+                values = self._iter_values([self.charset[0]] + chars)
+                append_data(next(values))  # Slot 0 is the default char
+                slots = {char: append_data(next(values)) // stride for char in chars}
+                if slot_map == dense_map:
+                    for char in self.charset[1:]:
+                        index += field(slots.get(char, 0), size)
+                else:
+                    for char in chars:
+                        sparse += field(ord(char), size) + field(slots[char], size)
+        elif self.index_type == "normal":
             # Build normal index. Efficient for ASCII set and smaller as
             # entries are 2 bytes (-> data[0] for absent glyph)
+            values = self._iter_values([char for char in self.charset if char])
             for char in self.charset:
                 if char == "":
-                    index += bytearray((0, 0))
+                    index += bytes(size)
                 else:
-                    index += (len(data)).to_bytes(2, byteorder="little")  # Start
-                    append_data(data, char)
-            index += (len(data)).to_bytes(2, byteorder="little")  # End
+                    index += field(append_data(next(values)), size)
+            index += field(offset, size)  # End
         else:
-            # Sparse index. Entries are 4 bytes but only populated if the char
-            # has a defined glyph.
-            append_data(data, self.charset[0])  # data[0] is the default char
-            for char in sorted(self.keys()):
-                sparse += ord(char).to_bytes(2, byteorder="little")
-                pad = len(data) % 8
-                if pad:  # Ensure len(data) % 8 == 0
-                    data += bytearray(8 - pad)
-                try:
-                    sparse += (len(data) >> 3).to_bytes(2, byteorder="little")  # Start
-                except OverflowError:
-                    raise ValueError("Total size of font bitmap exceeds 524287 bytes.")
-                append_data(data, char)
+            # Sparse, paged or range index. Only populated if the char has a
+            # defined glyph. Glyph data is stored in order of ordinal value.
+            values = self._iter_values([self.charset[0]] + chars)
+            append_data(next(values))  # data[0] is the default char
+            starts = []
+            for char in chars:
+                start = append_data(next(values), 1 << shift)  # Ensure offset % 8 == 0
+                starts.append(start >> shift)
+            if self.index_type == "paged":
+                index, sparse = paged_index(chars, starts, size)
+            elif self.index_type == "range":
+                index, sparse = range_index(chars, starts, size)
+            else:  # Sparse entries are ordinal value and start
+                if self.index_type == "hybrid":
+                    starts = dict(zip(chars, starts))
+                    for value in range(first, last + 1):  # Absent: data[0]
+                        index += field(starts.get(chr(value), 0), size)
+                    chars = others
+                    starts = [starts[char] for char in others]
+                for char, start in zip(chars, starts):
+                    sparse += field(ord(char), size) + field(start, size)
+        self.sizes = (raw, stored, largest)
+        self.duplicates = (records.duplicates, records.saved)
         return data, index, sparse
 
-    def build_binary_array(self, hmap, reverse, sig):
+    # Version 2 binary font file. Glyph data is passed to out as it is produced.
+    # Returns the header and index. See BINARY OUTPUT for the file layout.
+    def build_binary_font(self, hmap, reverse, out):
+        index = bytearray()
+        offset = 0  # Length of glyph data produced
+        widest = self.max_width  # A glyph may be wider: see _char_values()
+        records = Records()
+
+        # Return the offset of a glyph record, writing it unless an identical
+        # record exists.
+        def append_data(values):
+            nonlocal offset, widest
+            outbuffer, width, _ = values
+            widest = max(widest, width)
+            record = (width).to_bytes(2, byteorder="little")
+            record += bytes(Font._pack(outbuffer, hmap, reverse))
+            start = records.find(record)
+            if start is None:
+                start = records.add(record, offset)
+                out(record)
+                offset += len(record)
+            return start
+
+        chars = sorted(self.keys())
+        # Use whichever index is smaller. Both have the default char at offset 0.
+        sparse = BINARY_SPARSE.size * len(chars) < BINARY_DENSE.size * len(self.charset)
+        if sparse:  # Entries for defined chars only, sorted by ordinal value
+            values = self._iter_values([self.charset[0]] + chars)
+            append_data(next(values))
+            for char in chars:
+                index += BINARY_SPARSE.pack(ord(char), append_data(next(values)))
+            nentries = len(chars)
+        else:  # Entries for the default char then every char in range
+            values = self._iter_values([char for char in self.charset if char])
+            for char in self.charset:
+                if char == "":
+                    index += BINARY_DENSE.pack(0)
+                else:
+                    index += BINARY_DENSE.pack(append_data(next(values)))
+            nentries = len(self.charset)
+
+        flags = (
+            (BINARY_HMAP if hmap else 0)
+            | (BINARY_REVERSE if reverse else 0)
+            | (BINARY_MONOSPACED if self.monospaced else 0)
+            | (BINARY_SPARSE_INDEX if sparse else 0)
+        )
+        header = BINARY_HEADER.pack(
+            BINARY_MAGIC,
+            BINARY_VERSION,
+            flags,
+            self.height,
+            widest,  # Readers size glyph buffers from this
+            self._max_ascent,
+            min(self.crange),
+            max(self.crange),
+            nentries,
+            BINARY_HEADER.size + offset,  # Index follows glyph data
+            BINARY_HEADER.size,
+        )
+        self.duplicates = (records.duplicates, records.saved)
+        return header, index
+
+    def build_binary_array(self, hmap, reverse, sig, out=None):
         data = bytearray((0x3F + sig, 0xE7, self.max_width, self.height))
-        for char in self.charset:
-            width = self[char][2]
+        for outbuffer, _, width in self._iter_values(self.charset):
             data += bytes((width,))
-            data += bytearray(self.stream_char(char, hmap, reverse))
+            data += bytes(Font._pack(outbuffer, hmap, reverse))
+            if out is not None:
+                out(data)
+                data = bytearray()
         return data
 
 
+# Index field of size bytes.
+def field(value, size):
+    try:
+        return (value).to_bytes(size, byteorder="little")
+    except OverflowError:
+        if size == 3:
+            raise ValueError("Total size of font bitmap exceeds 16MB.")
+        raise OverflowError("Font requires 3 byte index fields.")
+
+
+# Two-level index for sparse fonts with constant time lookup. The page table
+# has an entry for each value of the high byte of ordinal values. This holds 0
+# if no glyphs exist, otherwise the page number + 1. Each page has a bitmap of
+# the glyphs present (MSB first), the number of glyphs preceding each byte of
+# the bitmap and the number of the first glyph in the page (size bytes, where
+# size is the index field size). Offsets of glyphs are size bytes each in
+# order of ordinal value.
+PAGE = 64  # Size of a page excluding the first glyph number
+
+
+def paged_size(npages, nchars, size):
+    return 256 + npages * (PAGE + size) + size * nchars
+
+
+def paged_index(chars, starts, size):
+    table = bytearray(256)
+    pages = bytearray()
+    for n, char in enumerate(chars):
+        high, low = divmod(ord(char), 256)
+        if not table[high]:
+            table[high] = len(pages) // (PAGE + size) + 1
+            pages += bytes(PAGE) + field(n, size)
+        pages[(table[high] - 1) * (PAGE + size) + low // 8] |= 0x80 >> (low % 8)
+    for page in range(0, len(pages), PAGE + size):
+        count = 0
+        for n in range(32):
+            pages[page + 32 + n] = count
+            count += bin(pages[page + n]).count("1")
+    offsets = b"".join(field(start, size) for start in starts)
+    return table + pages, offsets
+
+
+# Range index for sparse fonts. Each run of consecutive ordinal values has an
+# entry of three fields: the first ordinal value, the number of chars and the
+# number of the first glyph. Glyph offsets are as for the paged index.
+def range_runs(chars):
+    runs = []
+    for n, char in enumerate(chars):
+        if runs and ord(char) == runs[-1][0] + runs[-1][1]:
+            runs[-1][1] += 1
+        else:
+            runs.append([ord(char), 1, n])
+    return runs
+
+
+def range_size(chars, size):
+    return 3 * size * len(range_runs(chars)) + size * len(chars)
+
+
+def range_index(chars, starts, size):
+    ranges = bytearray()
+    for run in range_runs(chars):
+        for value in run:
+            ranges += field(value, size)
+    offsets = b"".join(field(start, size) for start in starts)
+    return ranges, offsets
+
+
+# Offsets of glyph records already output, keyed by a digest of the record so
+# that memory use is small when streaming.
+class Records(dict):
+    def __init__(self):
+        super().__init__()
+        self.duplicates = 0  # No. of records found
+        self.saved = 0  # Bytes saved
+
+    def find(self, record):
+        start = self.get(hashlib.sha1(record).digest())
+        if start is not None:
+            self.duplicates += 1
+            self.saved += len(record)
+        return start
+
+    def add(self, record, offset):
+        self[hashlib.sha1(record).digest()] = offset
+        return offset
+
+
 # PYTHON FILE WRITING
 # The index only holds the start of data so can't read next_offset but must
 # calculate it.
@@ -450,58 +1371,565 @@ class Font(dict):
 STR01 = """# Code generated by font_to_py.py.
 # Font: {}{}
 # Cmd: {}
-version = '0.42'
+version = '0.43'
 
 """
 
-# Code emitted for charsets spanning a small range of ordinal values
+# Code emitted for charsets spanning a small range of ordinal values.
+# Index lookup code defines _offset(ch) returning the offset of the glyph
+# record in _font. Lookups use indexing rather than slices to avoid allocation.
 STR02 = """_mvfont = memoryview(_font)
-_mvi = memoryview(_index)
-ifb = lambda l : l[0] | (l[1] << 8)
 
-def get_ch(ch):
+def _offset(ch):
     oc = ord(ch)
     ioff = 2 * (oc - {0} + 1) if oc >= {0} and oc <= {1} else 0
-    doff = ifb(_mvi[ioff : ])
-    width = ifb(_mvfont[doff : ])
+    return _index[ioff] | (_index[ioff + 1] << 8)
 """
 
 # Code emiited for large charsets, assumed by build_arrays() to be sparse.
 # Binary search of sorted sparse index.
 # Offset into data array is saved after dividing by 8
 STRSP = """_mvfont = memoryview(_font)
-_mvsp = memoryview(_sparse)
-ifb = lambda l : l[0] | (l[1] << 8)
-
-def bs(lst, val):
-    while True:
-        m = (len(lst) & ~ 7) >> 1
-        v = ifb(lst[m:])
-        if v == val:
-            return ifb(lst[m + 2:])
-        if not m:
-            return 0
-        lst = lst[m:] if v < val else lst[:m]
 
+def _offset(ch):
+    oc = ord(ch)
+    lo = 0
+    hi = len(_sparse) >> 2
+    while lo < hi:
+        m = (lo + hi) >> 1
+        p = m << 2
+        v = _sparse[p] | (_sparse[p + 1] << 8)
+        if v == oc:
+            return (_sparse[p + 2] | (_sparse[p + 3] << 8)) << 3
+        if v < oc:
+            lo = m + 1
+        else:
+            hi = m
+    return 0
+"""
+
+# Code emitted for large fonts (see build_arrays()) whose index fields are 3
+# bytes. Offsets in sparse indices are not divided by 8.
+STR02L = """_mvfont = memoryview(_font)
+i3 = lambda l, p : l[p] | (l[p + 1] << 8) | (l[p + 2] << 16)
+
+def _offset(ch):
+    oc = ord(ch)
+    ioff = 3 * (oc - {0} + 1) if oc >= {0} and oc <= {1} else 0
+    return i3(_index, ioff)
+"""
+
+STRSPL = """_mvfont = memoryview(_font)
+i3 = lambda l, p : l[p] | (l[p + 1] << 8) | (l[p + 2] << 16)
+
+def _offset(ch):
+    oc = ord(ch)
+    lo = 0
+    hi = len(_sparse) // 6
+    while lo < hi:
+        m = (lo + hi) >> 1
+        v = i3(_sparse, 6 * m)
+        if v == oc:
+            return i3(_sparse, 6 * m + 3)
+        if v < oc:
+            lo = m + 1
+        else:
+            hi = m
+    return 0
+"""
+
+# Code emitted for paged sparse fonts: see paged_index(). Glyphs preceding a
+# char in its page are counted from the bitmap.
+STRPG = """_mvfont = memoryview(_font)
+
+def _offset(ch):
+    oc = ord(ch)
+    page = _pages[oc >> 8] if oc < 0x10000 else 0
+    if page:
+        p = 256 + (page - 1) * {0}
+        lo = oc & 0xff
+        i = lo >> 3
+        byte = _pages[p + i]
+        if byte & (0x80 >> (lo & 7)):
+            n = _pages[p + 32 + i] + _pages[p + {1}] + (_pages[p + {2}] << 8)
+            byte >>= 8 - (lo & 7)
+            while byte:
+                n += byte & 1
+                byte >>= 1
+            return (_offsets[2 * n] | (_offsets[2 * n + 1] << 8)) << 3
+    return 0
+"""
+
+STRPGL = """_mvfont = memoryview(_font)
+i3 = lambda l, p : l[p] | (l[p + 1] << 8) | (l[p + 2] << 16)
+
+def _offset(ch):
+    oc = ord(ch)
+    page = _pages[oc >> 8] if oc < 0x10000 else 0
+    if page:
+        p = 256 + (page - 1) * {0}
+        lo = oc & 0xff
+        i = lo >> 3
+        byte = _pages[p + i]
+        if byte & (0x80 >> (lo & 7)):
+            n = _pages[p + 32 + i] + i3(_pages, p + {1})
+            byte >>= 8 - (lo & 7)
+            while byte:
+                n += byte & 1
+                byte >>= 1
+            return i3(_offsets, 3 * n)
+    return 0
+"""
+
+# Code emitted for sparse fonts with a range index: see range_index().
+# Binary search of the runs.
+STRRG = """_mvfont = memoryview(_font)
+
+def _offset(ch):
+    oc = ord(ch)
+    lo = 0
+    hi = len(_ranges) // 6
+    while lo < hi:
+        m = (lo + hi) >> 1
+        p = 6 * m
+        first = _ranges[p] | (_ranges[p + 1] << 8)
+        if oc < first:
+            hi = m
+        elif oc >= first + (_ranges[p + 2] | (_ranges[p + 3] << 8)):
+            lo = m + 1
+        else:
+            n = (_ranges[p + 4] | (_ranges[p + 5] << 8)) + oc - first
+            return (_offsets[2 * n] | (_offsets[2 * n + 1] << 8)) << 3
+    return 0
+"""
+
+STRRGL = """_mvfont = memoryview(_font)
+i3 = lambda l, p : l[p] | (l[p + 1] << 8) | (l[p + 2] << 16)
+
+def _offset(ch):
+    oc = ord(ch)
+    lo = 0
+    hi = len(_ranges) // 9
+    while lo < hi:
+        m = (lo + hi) >> 1
+        p = 9 * m
+        first = i3(_ranges, p)
+        if oc < first:
+            hi = m
+        elif oc >= first + i3(_ranges, p + 3):
+            lo = m + 1
+        else:
+            return i3(_offsets, 3 * (i3(_ranges, p + 6) + oc - first))
+    return 0
+"""
+
+# Code emitted for sparse fonts with a hybrid index. Chars in a dense range
+# are looked up in _index, others by binary search of _sparse.
+STRHY = """_mvfont = memoryview(_font)
+
+def _offset(ch):
+    oc = ord(ch)
+    if {0} <= oc <= {1}:
+        p = 2 * (oc - {0})
+        return (_index[p] | (_index[p + 1] << 8)) << 3
+    lo = 0
+    hi = len(_sparse) >> 2
+    while lo < hi:
+        m = (lo + hi) >> 1
+        p = m << 2
+        v = _sparse[p] | (_sparse[p + 1] << 8)
+        if v == oc:
+            return (_sparse[p + 2] | (_sparse[p + 3] << 8)) << 3
+        if v < oc:
+            lo = m + 1
+        else:
+            hi = m
+    return 0
+"""
+
+STRHYL = """_mvfont = memoryview(_font)
+i3 = lambda l, p : l[p] | (l[p + 1] << 8) | (l[p + 2] << 16)
+
+def _offset(ch):
+    oc = ord(ch)
+    if {0} <= oc <= {1}:
+        return i3(_index, 3 * (oc - {0}))
+    lo = 0
+    hi = len(_sparse) // 6
+    while lo < hi:
+        m = (lo + hi) >> 1
+        v = i3(_sparse, 6 * m)
+        if v == oc:
+            return i3(_sparse, 6 * m + 3)
+        if v < oc:
+            lo = m + 1
+        else:
+            hi = m
+    return 0
+"""
+
+# Lookup code emitted with --emitter viper. Index fields are read via raw
+# pointers. Entry counts are constants to avoid len() and division.
+STR02VP = """@micropython.viper
+def _offset(ch) -> int:
+    oc = int(ord(ch))
+    ioff = 0
+    if oc >= {0} and oc <= {1}:
+        ioff = 2 * (oc - {0} + 1)
+    p = ptr8(_index)
+    return p[ioff] | (p[ioff + 1] << 8)
+"""
+
+STRSPVP = """@micropython.viper
+def _offset(ch) -> int:
+    oc = int(ord(ch))
+    s = ptr8(_sparse)
+    lo = 0
+    hi = {0}
+    while lo < hi:
+        m = (lo + hi) >> 1
+        p = m << 2
+        v = s[p] | (s[p + 1] << 8)
+        if v == oc:
+            return (s[p + 2] | (s[p + 3] << 8)) << 3
+        if v < oc:
+            lo = m + 1
+        else:
+            hi = m
+    return 0
+"""
+
+STRPGVP = """@micropython.viper
+def _offset(ch) -> int:
+    oc = int(ord(ch))
+    if oc >= 0x10000:
+        return 0
+    pg = ptr8(_pages)
+    page = pg[oc >> 8]
+    if page == 0:
+        return 0
+    p = 256 + (page - 1) * {0}
+    lo = oc & 0xff
+    i = lo >> 3
+    byte = pg[p + i]
+    if (byte & (0x80 >> (lo & 7))) == 0:
+        return 0
+    n = pg[p + 32 + i] + pg[p + {1}] + (pg[p + {2}] << 8)
+    byte >>= 8 - (lo & 7)
+    while byte:
+        n += byte & 1
+        byte >>= 1
+    po = ptr8(_offsets)
+    return (po[2 * n] | (po[2 * n + 1] << 8)) << 3
+"""
+
+STRRGVP = """@micropython.viper
+def _offset(ch) -> int:
+    oc = int(ord(ch))
+    r = ptr8(_ranges)
+    lo = 0
+    hi = {0}
+    while lo < hi:
+        m = (lo + hi) >> 1
+        p = 6 * m
+        first = r[p] | (r[p + 1] << 8)
+        if oc < first:
+            hi = m
+        elif oc >= first + (r[p + 2] | (r[p + 3] << 8)):
+            lo = m + 1
+        else:
+            n = (r[p + 4] | (r[p + 5] << 8)) + oc - first
+            po = ptr8(_offsets)
+            return (po[2 * n] | (po[2 * n + 1] << 8)) << 3
+    return 0
+"""
+
+STRHYVP = """@micropython.viper
+def _offset(ch) -> int:
+    oc = int(ord(ch))
+    if oc >= {0} and oc <= {1}:
+        pi = ptr8(_index)
+        p = 2 * (oc - {0})
+        return (pi[p] | (pi[p + 1] << 8)) << 3
+    s = ptr8(_sparse)
+    lo = 0
+    hi = {2}
+    while lo < hi:
+        m = (lo + hi) >> 1
+        p = m << 2
+        v = s[p] | (s[p + 1] << 8)
+        if v == oc:
+            return (s[p + 2] | (s[p + 3] << 8)) << 3
+        if v < oc:
+            lo = m + 1
+        else:
+            hi = m
+    return 0
+"""
+
+# Code emitted with --emitter native or viper. The lookup code is compiled by
+# exec(), replacing the bytecode version. Where the emitter is unavailable (under
+# CPython or on ports without native code support) this fails and the bytecode
+# version is used.
+STREM = """
+try:
+    exec('''
+{}''')
+except (NameError, SyntaxError):
+    pass
+"""
+
+# Glyph access code following the index lookup code. body sets n, the length
+# of the bitmap, which starts at start in buffer buf. lookup() fills a list
+# or array res with integers: the offset of the bitmap in the buffer returned
+# by font_data(), the width and the length. It does not allocate. get_width()
+# reads the width field of the glyph record without accessing the bitmap.
+# {0} is the font height.
+STRGET = """
 def get_ch(ch):
-    doff = bs(_mvsp, ord(ch)) << 3
-    width = ifb(_mvfont[doff : ])
+    doff = _offset(ch)
+    width = _font[doff] | (_font[doff + 1] << 8)
+{body}
+    return {buf}[{start}:{start} + n], {{0}}, width
+
+def lookup(ch, res):
+    doff = _offset(ch)
+    width = _font[doff] | (_font[doff + 1] << 8)
+{body}
+    res[0] = {start}
+    res[1] = width
+    res[2] = n
+    return res
+
+def font_data():
+    return {buf}
+
+def get_width(ch):
+    doff = _offset(ch)
+    return _font[doff] | (_font[doff + 1] << 8)
+
 """
 
 # Code emitted for horizontally mapped fonts.
-STR02H = """
-    next_offs = doff + 2 + ((width - 1)//8 + 1) * {0}
-    return _mvfont[doff + 2:next_offs], {0}, width
+STR02H = STRGET.format(body="    n = ((width - 1)//8 + 1) * {0}", buf="_mvfont", start="doff + 2")
+
+# Code emitted for vertically mapped fonts.
+STR02V = STRGET.format(body="    n = (({0} - 1)//8 + 1) * width", buf="_mvfont", start="doff + 2")
+
+# Code emitted for compressed fonts: see Font._compress(). Glyphs are decoded
+# into a buffer which is overwritten by each call to get_ch or lookup.
+STRDC = """_buf = bytearray({})
+_mvbuf = memoryview(_buf)
+
+def _decode(doff, stride, length):
+    buf = _buf
+    o = 0
+    while o < length:
+        op = _font[doff]
+        doff += 1
+        n = (op & 0x7f) * stride
+        if op & 0x80:
+            for i in range(o, o + n):
+                buf[i] = buf[i - stride] if i >= stride else 0
+        else:
+            for i in range(n):
+                buf[o + i] = _font[doff + i]
+            doff += n
+        o += n
+    return length
 
 """
 
-# Code emitted for vertically mapped fonts.
-STR02V = """
-    next_offs = doff + 2 + (({0} - 1)//8 + 1) * width
-    return _mvfont[doff + 2:next_offs], {0}, width
+# Code emitted for compressed horizontally mapped fonts. The ink extents precede
+# the compressed glyph.
+STR02HC = STRGET.format(
+    body="    stride = (width - 1)//8 + 1\n    n = _decode(doff + 4, stride, stride * {0})",
+    buf="_mvbuf",
+    start="0",
+)
+
+# Code emitted for compressed vertically mapped fonts. {1} is the bytes per column.
+STR02VC = STRGET.format(
+    body="    n = _decode(doff + 4, {1}, {1} * width)", buf="_mvbuf", start="0"
+)
+
+# Code emitted for cropped horizontally mapped fonts. Glyph records comprise
+# the width, the x and y offsets, width and height of the ink box (1 byte each)
+# and the bitmap of the ink box. get_glyph returns the ink box; size is the
+# length of its bitmap. get_ch and lookup expand the glyph into a buffer which
+# is overwritten by each call.
+STRCR = """
+def get_glyph(ch):
+    doff = _offset(ch)
+    width = _font[doff] | (_font[doff + 1] << 8)
+    bw = _font[doff + 4]
+    bh = _font[doff + 5]
+    next_offs = doff + 6 + {size}
+    return _mvfont[doff + 6:next_offs], bh, bw, _font[doff + 2], _font[doff + 3], width
+
+_buf = bytearray({{1}})
+_mvbuf = memoryview(_buf)
+
+def _expand(doff, width):
+    bx = _font[doff + 2]
+    by = _font[doff + 3]
+    bw = _font[doff + 4]
+    bh = _font[doff + 5]
+    doff += 6
+"""
+
+STR02HCR = STRCR.format(size="((bw - 1)//8 + 1) * bh") + """    ss = (bw - 1)//8 + 1
+    ds = (width - 1)//8 + 1
+    n = ds * {0}
+    for i in range(n):
+        _buf[i] = 0
+    for r in range(bh):
+        for c in range(bw):
+            if _font[doff + r * ss + (c >> 3)] & {2}:
+                x = c + bx
+                _buf[(r + by) * ds + (x >> 3)] |= {3}
+    return n
+""" + STRGET.format(body="    n = _expand(doff, width)", buf="_mvbuf", start="0")
+
+# Code emitted for cropped vertically mapped fonts. {4} is the bytes per column.
+STR02VCR = STRCR.format(size="((bh - 1)//8 + 1) * bw") + """    ss = (bh - 1)//8 + 1
+    ds = {4}
+    n = ds * width
+    for i in range(n):
+        _buf[i] = 0
+    for c in range(bw):
+        for r in range(bh):
+            if _font[doff + c * ss + (r >> 3)] & {2}:
+                y = r + by
+                _buf[(c + bx) * ds + (y >> 3)] |= {3}
+    return n
+""" + STRGET.format(body="    n = _expand(doff, width)", buf="_mvbuf", start="0")
+
+# get_ink() returns the first ink column of a glyph and the column after the
+# last, or 0, 0 for a blank glyph. body sets p, the position of the extents in
+# the glyph record.
+STRINK = """
+def get_ink(ch):
+    doff = _offset(ch)
+{body}
+    return _font[p], _font[p + 1]
 
 """
 
+STRINKH = STRINK.format(
+    body="    width = _font[doff] | (_font[doff + 1] << 8)\n"
+    "    p = doff + 2 + ((width - 1)//8 + 1) * {0}"
+)
+
+STRINKV = STRINK.format(
+    body="    width = _font[doff] | (_font[doff + 1] << 8)\n"
+    "    p = doff + 2 + (({0} - 1)//8 + 1) * width"
+)
+
+STRINKC = STRINK.format(body="    p = doff + 2")
+
+# Cropped glyphs: the extents are those of the ink box.
+STRINKCR = """
+def get_ink(ch):
+    doff = _offset(ch)
+    return _font[doff + 2], _font[doff + 2] + _font[doff + 4]
+
+"""
+
+# Code emitted for monospaced fonts with a fixed stride layout: see
+# build_arrays(). Glyph records comprise the bitmap and the ink extents, and
+# _offset returns the offset of the bitmap. Where the charset has no gaps the
+# offset is computed from the ordinal value.
+STRFX = """_mvfont = memoryview(_font)
+
+def _offset(ch):
+    oc = ord(ch)
+    return (oc - {0} + 1) * {2} if oc >= {0} and oc <= {1} else 0
+"""
+
+# _slots has an entry for each ordinal value in the range.
+STRFXD = """_mvfont = memoryview(_font)
+
+def _offset(ch):
+    oc = ord(ch)
+    if oc >= {0} and oc <= {1}:
+        p = 2 * (oc - {0})
+        return (_slots[p] | (_slots[p + 1] << 8)) * {2}
+    return 0
+"""
+
+STRFXDL = """_mvfont = memoryview(_font)
+i3 = lambda l, p : l[p] | (l[p + 1] << 8) | (l[p + 2] << 16)
+
+def _offset(ch):
+    oc = ord(ch)
+    if oc >= {0} and oc <= {1}:
+        return i3(_slots, 3 * (oc - {0})) * {2}
+    return 0
+"""
+
+# Binary search of _slots whose entries are the ordinal value and the slot.
+STRFXS = """_mvfont = memoryview(_font)
+
+def _offset(ch):
+    oc = ord(ch)
+    lo = 0
+    hi = len(_slots) >> 2
+    while lo < hi:
+        m = (lo + hi) >> 1
+        p = m << 2
+        v = _slots[p] | (_slots[p + 1] << 8)
+        if v == oc:
+            return (_slots[p + 2] | (_slots[p + 3] << 8)) * {0}
+        if v < oc:
+            lo = m + 1
+        else:
+            hi = m
+    return 0
+"""
+
+STRFXSL = """_mvfont = memoryview(_font)
+i3 = lambda l, p : l[p] | (l[p + 1] << 8) | (l[p + 2] << 16)
+
+def _offset(ch):
+    oc = ord(ch)
+    lo = 0
+    hi = len(_slots) // 6
+    while lo < hi:
+        m = (lo + hi) >> 1
+        v = i3(_slots, 6 * m)
+        if v == oc:
+            return i3(_slots, 6 * m + 3) * {0}
+        if v < oc:
+            lo = m + 1
+        else:
+            hi = m
+    return 0
+"""
+
+# Glyph access code for fixed stride fonts. {0} is the height, {1} the width and
+# {2} the length of the bitmap.
+STRFXT = """
+def get_ch(ch):
+    doff = _offset(ch)
+    return _mvfont[doff:doff + {2}], {0}, {1}
+
+def lookup(ch, res):
+    res[0] = _offset(ch)
+    res[1] = {1}
+    res[2] = {2}
+    return res
+
+def font_data():
+    return _mvfont
+
+def get_width(ch):
+    return {1}
+
+"""
+
+STRINKFX = STRINK.format(body="    p = doff + {2}")
+
 # Extra code emitted where -i is specified.
 STR03 = '''
 def glyphs():
@@ -528,22 +1956,81 @@ def write_font(
     charset,
     iterate,
     bitmapped,
+    jobs=1,
+    cache=None,
+    streaming=False,
+    coverage=False,
+    compress=False,
+    crop=False,
+    layout="auto",
+    dense=(MINCHAR, MAXCHAR),
+    emitter="bytecode",
 ):
     try:
-        fnt = Font(font_path, height, minchar, maxchar, monospaced, defchar, charset, bitmapped)
+        fnt = Font(
+            font_path,
+            height,
+            minchar,
+            maxchar,
+            monospaced,
+            defchar,
+            charset,
+            bitmapped,
+            jobs,
+            cache,
+            streaming,
+        )
     except freetype.ft_errors.FT_Exception:
         print("Can't open", font_path)
         return False
+    report_missing(fnt, coverage)
     try:
+        # Check before the output file is opened to avoid leaving it part written.
+        if crop and max(fnt.height, fnt.max_width) > 255:
+            quit("--crop requires glyphs < 256 pixels high and wide.")
+        if layout == "paged":
+            ordinals = [ord(char) for char in fnt.keys()]
+            if max(ordinals) > 0xFFFF:
+                quit("--index paged requires ordinal values < 0x10000.")
+            if len({ordv >> 8 for ordv in ordinals}) > 255:
+                quit("--index paged supports at most 255 pages of 256 chars.")
         with open(op_path, "w", encoding="utf-8") as stream:
-            write_data(stream, fnt, font_path, hmap, reverse, iterate, charset)
+            write_data(
+                stream,
+                fnt,
+                font_path,
+                hmap,
+                reverse,
+                iterate,
+                charset,
+                compress,
+                crop,
+                layout,
+                dense,
+                emitter,
+            )
     except OSError:
         print("Can't open", op_path, "for writing")
         return False
+    finally:
+        fnt.close()
     return True
 
 
-def write_data(stream, fnt, font_path, hmap, reverse, iterate, charset):
+def write_data(
+    stream,
+    fnt,
+    font_path,
+    hmap,
+    reverse,
+    iterate,
+    charset,
+    compress=False,
+    crop=False,
+    layout="auto",
+    dense=(MINCHAR, MAXCHAR),
+    emitter="bytecode",
+):
     height = fnt.height  # Actual height, not target height
     minchar = min(fnt.crange)
     maxchar = max(fnt.crange)
@@ -561,37 +2048,243 @@ def write_data(stream, fnt, font_path, hmap, reverse, iterate, charset):
     write_func(stream, "max_ch", maxchar)
     if iterate:
         stream.write(STR03.format("".join(sorted(fnt.keys()))))
-    data, index, sparse = fnt.build_arrays(hmap, reverse)
-    bw_font = ByteWriter(stream, "_font")
-    bw_font.odata(data)
+    start = stream.tell()
+    try:
+        bw_font = ByteWriter(stream, "_font")
+        _, index, sparse = fnt.build_arrays(
+            hmap, reverse, bw_font.odata, compress, crop, layout, False, dense
+        )
+    except OverflowError:  # Index fields too small: start again
+        stream.seek(start)
+        stream.truncate()
+        bw_font = ByteWriter(stream, "_font")
+        _, index, sparse = fnt.build_arrays(
+            hmap, reverse, bw_font.odata, compress, crop, layout, True, dense
+        )
     bw_font.eot()
-    if sparse:  # build_arrays() has returned a sparse index
+    if fnt.large:
+        print("Large font: index fields are 3 bytes.")
+    raw, stored, largest = fnt.sizes
+    if compress:
+        st = "Compressed glyph data {} bytes, raw {} bytes ({:.0%})."
+        print(st.format(stored, raw, stored / raw if raw else 1))
+        stream.write(STRDC.format(largest))
+    if crop:
+        st = "Cropped glyph data {} bytes, uncropped {} bytes ({:.0%})."
+        print(st.format(stored, raw, stored / raw if raw else 1))
+    report_duplicates(fnt)
+    vhead = None  # Viper lookup code
+    if fnt.index_type == "fixed":
+        if index:
+            bw_slots = ByteWriter(stream, "_slots")
+            bw_slots.odata(index)
+            bw_slots.eot()
+            head = (STRFXDL if fnt.large else STRFXD).format(minchar, maxchar, fnt.stride)
+        elif sparse:
+            bw_slots = ByteWriter(stream, "_slots")
+            bw_slots.odata(sparse)
+            bw_slots.eot()
+            head = (STRFXSL if fnt.large else STRFXS).format(fnt.stride)
+        else:
+            head = STRFX.format(minchar, maxchar, fnt.stride)
+        print("Monospaced font file with fixed stride {} bytes.".format(fnt.stride))
+    elif fnt.index_type == "sparse":
         bw_sparse = ByteWriter(stream, "_sparse")
         bw_sparse.odata(sparse)
         bw_sparse.eot()
-        stream.write(STRSP)
+        head = STRSPL if fnt.large else STRSP
+        vhead = STRSPVP.format(len(sparse) >> 2)
         print("Sparse font file.")
+    elif fnt.index_type == "paged":
+        bw_pages = ByteWriter(stream, "_pages")
+        bw_pages.odata(index)
+        bw_pages.eot()
+        bw_offsets = ByteWriter(stream, "_offsets")
+        bw_offsets.odata(sparse)
+        bw_offsets.eot()
+        if fnt.large:
+            head = STRPGL.format(PAGE + 3, PAGE)
+        else:
+            head = STRPG.format(PAGE + 2, PAGE, PAGE + 1)
+            vhead = STRPGVP.format(PAGE + 2, PAGE, PAGE + 1)
+        print("Sparse font file with paged index.")
+    elif fnt.index_type == "range":
+        bw_ranges = ByteWriter(stream, "_ranges")
+        bw_ranges.odata(index)
+        bw_ranges.eot()
+        bw_offsets = ByteWriter(stream, "_offsets")
+        bw_offsets.odata(sparse)
+        bw_offsets.eot()
+        head = STRRGL if fnt.large else STRRG
+        vhead = STRRGVP.format(len(index) // 6)
+        print("Sparse font file with range index.")
+    elif fnt.index_type == "hybrid":
+        bw_index = ByteWriter(stream, "_index")
+        bw_index.odata(index)
+        bw_index.eot()
+        if sparse:
+            bw_sparse = ByteWriter(stream, "_sparse")
+            bw_sparse.odata(sparse)
+            bw_sparse.eot()
+        else:  # All chars are in the dense range
+            var_write(stream, "_sparse", "b''")
+        head = (STRHYL if fnt.large else STRHY).format(*dense)
+        vhead = STRHYVP.format(*dense, len(sparse) >> 2)
+        print("Sparse font file with hybrid index.")
     else:
         bw_index = ByteWriter(stream, "_index")
         bw_index.odata(index)
         bw_index.eot()
-        stream.write(STR02.format(minchar, maxchar))
+        head = (STR02L if fnt.large else STR02).format(minchar, maxchar)
+        vhead = STR02VP.format(minchar, maxchar)
         print("Normal (non-sparse) font file.")
-    if hmap:
+    stream.write(head)
+    if emitter == "viper" and (fnt.large or vhead is None):  # Assumes 2 byte fields
+        print("No viper code for this index: using native emitter.")
+        emitter = "native"
+    if emitter == "viper":
+        stream.write(STREM.format(vhead))
+    elif emitter == "native":
+        stream.write(STREM.format("@micropython.native\n" + head[head.index("def _offset") :]))
+    if fnt.index_type == "fixed":
+        length = fnt.stride - 2 if fnt.max_width < 256 else fnt.stride
+        stream.write(STRFXT.format(height, fnt.max_width, length))
+    elif crop:
+        # Masks of the pixels in column c of the box and x of the glyph.
+        if hmap:
+            masks = ("(1 << (c & 7))", "(1 << (x & 7))")
+            if not reverse:
+                masks = ("(0x80 >> (c & 7))", "(0x80 >> (x & 7))")
+            stream.write(STR02HCR.format(height, largest, *masks))
+        else:  # Masks of the pixels in row r of the box and y of the glyph.
+            masks = ("(1 << (r & 7))", "(1 << (y & 7))")
+            if reverse:
+                masks = ("(0x80 >> (r & 7))", "(0x80 >> (y & 7))")
+            stream.write(STR02VCR.format(height, largest, *masks, (height - 1) // 8 + 1))
+    elif compress:
+        if hmap:
+            stream.write(STR02HC.format(height))
+        else:
+            stream.write(STR02VC.format(height, (height - 1) // 8 + 1))
+    elif hmap:
         stream.write(STR02H.format(height))
     else:
         stream.write(STR02V.format(height))
+    if fnt.max_width > 255:
+        print("Glyphs are too wide to store ink extents.")
+    elif fnt.index_type == "fixed":
+        stream.write(STRINKFX.format(height, fnt.max_width, length))
+    elif crop:
+        stream.write(STRINKCR)
+    else:
+        stream.write((STRINKC if compress else STRINKH if hmap else STRINKV).format(height))
+
+
+def report_duplicates(fnt):
+    glyphs, saved = fnt.duplicates
+    if glyphs:
+        print("{} duplicate glyphs stored once, saving {} bytes.".format(glyphs, saved))
+
+
+def report_missing(fnt, coverage):
+    if fnt.missing:
+        st = "{} characters in the charset are not supported by the font."
+        print(st.format(len(fnt.missing)))
+        if coverage:
+            for char in fnt.missing:
+                print("U+{:04X} {}".format(ord(char), char))
 
 
 # BINARY OUTPUT
+# Version 2 files comprise a 32 byte header, glyph data and an index. Integers
+# are little-endian. Header fields:
+# Magic b"FPYB", version (1 byte), flags (1 byte), height, max_width, baseline
+# (2 bytes each), min_ch, max_ch, number of index entries, offset of index,
+# offset of glyph data (4 bytes each). Offsets are from the start of the file.
+# Glyph records are as in Python font files: width (2 bytes) followed by the
+# bitmap. The record of the default char is at the start of the glyph data.
+# A dense index has 4 byte entries holding the offset of a glyph record
+# relative to the start of glyph data. Entry 0 is the default char, followed
+# by one entry for each ordinal value from min_ch to max_ch. Absent chars have
+# an offset of 0 (the default char).
+# A sparse index has 8 byte entries comprising an ordinal value and an offset.
+# Entries are sorted by ordinal value.
+BINARY_MAGIC = b"FPYB"
+BINARY_VERSION = 2
+BINARY_HEADER = struct.Struct("<4sBBHHHIIIII")
+BINARY_DENSE = struct.Struct("<I")
+BINARY_SPARSE = struct.Struct("<II")
+# Flags
+BINARY_HMAP = 1
+BINARY_REVERSE = 2
+BINARY_MONOSPACED = 4
+BINARY_SPARSE_INDEX = 8
+
+
+def write_binary_font_v2(
+    op_path,
+    font_path,
+    height,
+    monospaced,
+    hmap,
+    reverse,
+    minchar,
+    maxchar,
+    defchar,
+    charset,
+    bitmapped,
+    jobs=1,
+    cache=None,
+    streaming=False,
+    coverage=False,
+):
+    try:
+        fnt = Font(
+            font_path,
+            height,
+            minchar,
+            maxchar,
+            monospaced,
+            defchar,
+            charset,
+            bitmapped,
+            jobs,
+            cache,
+            streaming,
+        )
+    except freetype.ft_errors.FT_Exception:
+        print("Can't open", font_path)
+        return False
+    report_missing(fnt, coverage)
+    try:
+        with open(op_path, "wb") as stream:
+            stream.write(bytes(BINARY_HEADER.size))  # Written when data size is known
+            header, index = fnt.build_binary_font(hmap, reverse, stream.write)
+            stream.write(index)
+            stream.seek(0)
+            stream.write(header)
+    except OSError:
+        print("Can't open", op_path, "for writing")
+        return False
+    finally:
+        fnt.close()
+    report_duplicates(fnt)
+    print("{} index.".format("Sparse" if header[5] & BINARY_SPARSE_INDEX else "Dense"))
+    return True
+
+
+# Version 1 binary font files support only fixed width ASCII 32-126.
 # hmap reverse magic bytes
 # 0    0       0x3f 0xe7
 # 1    0       0x40 0xe7
 # 0    1       0x41 0xe7
 # 1    1       0x42 0xe7
-def write_binary_font(op_path, font_path, height, hmap, reverse):
+def write_binary_font(
+    op_path, font_path, height, hmap, reverse, jobs=1, cache=None, streaming=False
+):
     try:
-        fnt = Font(font_path, height, 32, 126, True, None, "", False)  # All chars have same width
+        # All chars have same width
+        fnt = Font(font_path, height, 32, 126, True, None, "", False, jobs, cache, streaming)
     except freetype.ft_errors.FT_Exception:
         print("Can't open", font_path)
         return False
@@ -600,11 +2293,12 @@ def write_binary_font(op_path, font_path, height, hmap, reverse):
         sig += 2
     try:
         with open(op_path, "wb") as stream:
-            data = fnt.build_binary_array(hmap, reverse, sig)
-            stream.write(data)
+            fnt.build_binary_array(hmap, reverse, sig, stream.write)
     except OSError:
         print("Can't open", op_path, "for writing")
         return False
+    finally:
+        fnt.close()
     return True
 
 
@@ -629,9 +2323,9 @@ To specify monospaced rendering issue:
 font_to_py.py FreeSans.ttf 23 --fixed freesans.py
 """
 
-BINARY = """Invalid arguments. Binary (random access) font files support the standard ASCII
-character set (from 32 to 126 inclusive). This range cannot be overridden.
-Random access font files don't support an error character.
+BINARY = """Invalid arguments. Version 1 binary (random access) font files support the
+standard ASCII character set (from 32 to 126 inclusive). This range cannot be
+overridden. They don't support an error character.
 """
 
 
@@ -639,9 +2333,9 @@ def main():
     parser = argparse.ArgumentParser(
         __file__, description=DESC, formatter_class=argparse.RawDescriptionHelpFormatter
     )
-    parser.add_argument("infile", type=str, help="Input file path")
-    parser.add_argument("height", type=int, help="Font height in pixels")
-    parser.add_argument("outfile", type=str, help="Path and name of output file")
+    parser.add_argument("infile", type=str, nargs="?", help="Input file path")
+    parser.add_argument("height", type=int, nargs="?", help="Font height in pixels")
+    parser.add_argument("outfile", type=str, nargs="?", help="Path and name of output file")
 
     parser.add_argument("-x", "--xmap", action="store_true", help="Horizontal (x) mapping")
     parser.add_argument("-y", "--ymap", action="store_true", help="Vertical (y) mapping")
@@ -650,6 +2344,14 @@ def main():
     parser.add_argument(
         "-b", "--binary", action="store_true", help="Produce binary (random access) font file."
     )
+    parser.add_argument(
+        "--binary-version",
+        type=int,
+        choices=(1, 2),
+        default=BINARY_VERSION,
+        help="Binary font file format version default %(default)i",
+    )
+
     parser.add_argument(
         "-i",
         "--iterate",
@@ -657,6 +2359,47 @@ def main():
         help="Include generator function to iterate over character set.",
     )
 
+    parser.add_argument(
+        "--batch",
+        type=str,
+        help="Convert the fonts listed in a JSON manifest file.",
+        default="",
+    )
+
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of processes used to render glyphs default %(default)i",
+    )
+
+    parser.add_argument(
+        "--packed",
+        action="store_true",
+        help="Hold glyphs in memory with one bit per pixel.",
+    )
+
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Render glyphs as they are output to minimise memory use.",
+    )
+
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        help="Directory in which to cache rendered glyphs between runs.",
+        default="",
+    )
+
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=256,
+        help="Maximum size of glyph cache in MB default %(default)i",
+    )
+
     parser.add_argument(
         "-s",
         "--smallest",
@@ -697,7 +2440,58 @@ def main():
         default="",
     )
 
-    args = parser.parse_args()
+    parser.add_argument(
+        "--coverage",
+        action="store_true",
+        help="List characters in the charset which the font does not support.",
+    )
+
+    parser.add_argument(
+        "--compress",
+        action="store_true",
+        help="Compress glyphs in Python font files.",
+    )
+
+    parser.add_argument(
+        "--crop",
+        action="store_true",
+        help="Store glyphs in Python font files cropped to their ink box.",
+    )
+
+    parser.add_argument(
+        "--index",
+        choices=("auto", "normal", "sparse", "paged", "range", "hybrid", "fixed"),
+        default="auto",
+        help="Index type of Python font files default %(default)s",
+    )
+
+    parser.add_argument(
+        "--dense-range",
+        type=int,
+        nargs=2,
+        default=(MINCHAR, MAXCHAR),
+        metavar=("FIRST", "LAST"),
+        help="Ordinal values in the dense part of a hybrid index default %(default)s",
+    )
+
+    parser.add_argument(
+        "--emitter",
+        choices=("bytecode", "native", "viper"),
+        default="bytecode",
+        help="MicroPython code emitter for glyph lookup default %(default)s",
+    )
+
+    args = parser.parse_intermixed_args()
+    if args.batch:
+        sys.exit(0 if batch(args) else 1)
+    if args.outfile is None:
+        parser.error("the following arguments are required: infile, height, outfile")
+    if not convert(args):
+        sys.exit(1)
+
+
+# Perform a single conversion. Invalid args cause an exit via quit().
+def convert(args, cache=None):
     if not args.outfile[0].isalpha():
         quit("Font filenames must be valid Python variable names.")
 
@@ -711,21 +2505,59 @@ def main():
         quit("Cannot be both horizontally and vertically mapped.")
 
     xmap = args.xmap or not args.ymap  # Default is now horizontal
+    select_bitmap(args.packed)
+
+    if args.jobs < 1:
+        quit("--jobs must be >= 1")
+
+    if args.compress and args.crop:
+        quit("--compress and --crop are mutually exclusive.")
+
+    if args.index == "fixed" and (not args.fixed or args.compress or args.crop):
+        quit("--index fixed requires --fixed and is incompatible with --compress and --crop.")
+
+    if not 0 <= args.dense_range[0] <= args.dense_range[1]:
+        quit("--dense-range values must be >= 0 and in ascending order.")
+
+    if args.cache_dir and cache is None:
+        if args.cache_size < 1:
+            quit("--cache-size must be >= 1")
+        cache = GlyphCache(args.cache_dir, args.infile, args.cache_size * 1024 * 1024)
 
+    binary_v1 = args.binary and args.binary_version == 1
     if args.binary:
         if os.path.splitext(args.outfile)[1].upper() == ".PY":
             quit("Binary file must not have a .py extension.")
 
-        if args.smallest != 32 or args.largest != 126 or args.errchar != ord("?") or args.charset:
+        if binary_v1 and (
+            args.smallest != 32
+            or args.largest != 126
+            or args.errchar != ord("?")
+            or args.charset
+            or args.charset_file
+        ):
             quit(BINARY)
-
+        if args.compress or args.crop:
+            quit("--compress and --crop are not supported for binary font files.")
+        if args.emitter != "bytecode":
+            quit("--emitter is not supported for binary font files.")
+    elif not os.path.splitext(args.outfile)[1].upper() == ".PY":
+        quit("Output filename must have a .py extension.")
+
+    if binary_v1:
         print("Writing binary font file.")
-        if not write_binary_font(args.outfile, args.infile, args.height, xmap, args.reverse):
-            sys.exit(1)
+        if not write_binary_font(
+            args.outfile,
+            args.infile,
+            args.height,
+            xmap,
+            args.reverse,
+            args.jobs,
+            cache,
+            args.stream,
+        ):
+            return False
     else:
-        if not os.path.splitext(args.outfile)[1].upper() == ".PY":
-            quit("Output filename must have a .py extension.")
-
         if args.smallest < 0:
             quit("--smallest must be >= 0")
 
@@ -745,7 +2577,7 @@ def main():
                     cset = f.read()
             except OSError:
                 print("Can't open", args.charset_file, "for reading.")
-                sys.exit(1)
+                return False
         else:
             cset = args.charset
         # dedupe and remove default char. Allow chars in private use area.
@@ -757,28 +2589,133 @@ def main():
         if bitmapped:
             if args.height != 0:
                 print("Warning: height arg ignored for bitmapped fonts.")
-            chkface = freetype.Face(args.infile)
+            chkface = get_face(args.infile)
             args.height = chkface._get_available_sizes()[0].height
             print("Found font with size " + str(args.height))
 
-        print("Writing Python font file.")
-        if not write_font(
-            args.outfile,
-            args.infile,
-            args.height,
-            args.fixed,
-            xmap,
-            args.reverse,
-            args.smallest,
-            args.largest,
-            args.errchar,
-            cset,
-            args.iterate,
-            bitmapped,
-        ):
-            sys.exit(1)
+        if args.binary:
+            print("Writing binary font file.")
+            if not write_binary_font_v2(
+                args.outfile,
+                args.infile,
+                args.height,
+                args.fixed,
+                xmap,
+                args.reverse,
+                args.smallest,
+                args.largest,
+                args.errchar,
+                cset,
+                bitmapped,
+                args.jobs,
+                cache,
+                args.stream,
+                args.coverage,
+            ):
+                return False
+        else:
+            print("Writing Python font file.")
+            if not write_font(
+                args.outfile,
+                args.infile,
+                args.height,
+                args.fixed,
+                xmap,
+                args.reverse,
+                args.smallest,
+                args.largest,
+                args.errchar,
+                cset,
+                args.iterate,
+                bitmapped,
+                args.jobs,
+                cache,
+                args.stream,
+                args.coverage,
+                args.compress,
+                args.crop,
+                args.index,
+                args.dense_range,
+                args.emitter,
+            ):
+                return False
 
     print(args.outfile, "written successfully.")
+    return True
+
+
+# BATCH CONVERSION
+# The manifest is a JSON list of entries, each a dict whose keys are the long
+# names of the command line args e.g.
+# [{"infile": "FreeSans.ttf", "height": [17, 23], "outfile": "freesans{height}.py",
+#   "charset_file": "charsets/extended", "reverse": true}]
+# "height" may be a list in which case "{height}" in outfile is replaced by
+# each value. Args on the command line are defaults for all entries.
+
+BATCH_KEYS = ("infile", "height", "outfile")
+
+
+def batch_entries(args, manifest):
+    for entry in manifest:
+        if not isinstance(entry, dict) or any(key not in entry for key in BATCH_KEYS):
+            msg = "Manifest entries must specify {}.".format(", ".join(BATCH_KEYS))
+            yield None, str(entry), msg
+            continue
+        unknown = [key for key in entry if key not in vars(args)]
+        if unknown:
+            yield None, entry["outfile"], "Unknown manifest key {}.".format(", ".join(unknown))
+            continue
+        heights = entry["height"] if isinstance(entry["height"], list) else [entry["height"]]
+        for height in heights:
+            eargs = argparse.Namespace(**vars(args))
+            eargs.batch = ""
+            for key, value in entry.items():
+                setattr(eargs, key, value)
+            eargs.height = height
+            eargs.outfile = entry["outfile"].format(height=height)
+            yield eargs, eargs.outfile, ""
+
+
+def batch(args):
+    try:
+        with open(args.batch, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        print("Can't read manifest", args.batch, e)
+        return False
+    if not isinstance(manifest, list):
+        print("Manifest must be a list of entries.")
+        return False
+    caches = {}  # One GlyphCache per font file
+    results = []
+    for eargs, name, err in batch_entries(args, manifest):
+        if eargs is None:
+            print(err)
+            results.append((name, False, 0))
+            continue
+        start = time.perf_counter()
+        try:
+            cache = None
+            if eargs.cache_dir and os.path.isfile(eargs.infile):
+                key = (eargs.cache_dir, eargs.infile)
+                if key not in caches:
+                    max_bytes = eargs.cache_size * 1024 * 1024
+                    caches[key] = GlyphCache(eargs.cache_dir, eargs.infile, max_bytes)
+                cache = caches[key]
+            ok = convert(eargs, cache)
+        except SystemExit:  # Invalid args: message has been printed by quit()
+            ok = False
+        except Exception as e:  # Font can't be converted: carry on with the rest
+            print("Error converting {}: {}".format(name, e))
+            ok = False
+        results.append((name, ok, time.perf_counter() - start))
+
+    print("Batch results:")
+    for name, ok, seconds in results:
+        print("{:6.2f}s {} {}".format(seconds, "OK    " if ok else "FAILED", name))
+    failed = sum(not ok for _, ok, _ in results)
+    print("{} of {} conversions failed.".format(failed, len(results)))
+    return not failed
 
 
 if __name__ == "__main__":
@@ -0,0 +1,185 @@
+# binfont.py Read glyphs from a binary font file created by font_to_py.py -b
+
+# Released under the MIT License (MIT). See LICENSE.
+# Copyright (c) 2026 Peter Hinch
+
+# A BinFont has the same interface as a Python font file so may be passed to a
+# Writer or CWriter. Glyphs are read from the file on demand into preallocated
+# buffers: the font uses a fixed amount of RAM regardless of the file size.
+# Recently used glyphs are retained in an LRU cache of cache_size glyphs.
+# The buffer returned by get_ch is valid until the glyph is evicted, i.e. until
+# at least cache_size further glyphs have been read.
+
+# Usage:
+# from writer import Writer
+# from binfont import BinFont
+# font = BinFont("/sd/freesans40.bin", cache_size=32)
+# wri = Writer(ssd, font)
+
+import struct
+
+_MAGIC = b"FPYB"
+_VERSION = 2
+_HEADER = "<4sBBHHHIIIII"  # See writer/DRIVERS.md
+_HDRSIZE = 32
+# Flags
+_HMAP = 1
+_REVERSE = 2
+_MONOSPACED = 4
+_SPARSE = 8
+
+
+# Little-endian unsigned integer from a 4 byte buffer slice. Avoids allocation.
+def _u32(buf, i):
+    return buf[i] | buf[i + 1] << 8 | buf[i + 2] << 16 | buf[i + 3] << 24
+
+
+class BinFont:
+    def __init__(self, filename, cache_size=16):
+        if cache_size < 1:
+            raise ValueError("cache_size must be >= 1")
+        self._f = f = open(filename, "rb")
+        hdr = f.read(_HDRSIZE)
+        if len(hdr) != _HDRSIZE or hdr[:4] != _MAGIC:
+            f.close()
+            raise ValueError("Not a binary font file.")
+        (
+            _,
+            version,
+            flags,
+            self._height,
+            self._max_width,
+            self._baseline,
+            self._min_ch,
+            self._max_ch,
+            self._nentries,
+            self._index,
+            self._data,
+        ) = struct.unpack(_HEADER, hdr)
+        if version != _VERSION:
+            f.close()
+            raise ValueError("Unsupported binary font file version {}.".format(version))
+        self._flags = flags
+        self._entry = bytearray(8)  # Index entry or width
+        mv = memoryview(self._entry)
+        self._mv8 = mv  # Sparse index entry
+        self._mv4 = mv[:4]  # Dense index entry
+        self._mv2 = mv[:2]  # Glyph width
+        gbytes = self._glen(self._max_width)  # Size of the largest glyph bitmap
+        self._bufs = [memoryview(bytearray(gbytes)) for _ in range(cache_size)]
+        self._widths = [0] * cache_size
+        self._lens = [0] * cache_size
+        self._used = [0] * cache_size  # Time of last use of each slot
+        self._chars = [None] * cache_size  # Char held in each slot
+        self._slots = {}  # Slot index of each cached char
+        self._tick = 0
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        self._f.close()
+
+    def height(self):
+        return self._height
+
+    def baseline(self):
+        return self._baseline
+
+    def max_width(self):
+        return self._max_width
+
+    def hmap(self):
+        return bool(self._flags & _HMAP)
+
+    def reverse(self):
+        return bool(self._flags & _REVERSE)
+
+    def monospaced(self):
+        return bool(self._flags & _MONOSPACED)
+
+    def min_ch(self):
+        return self._min_ch
+
+    def max_ch(self):
+        return self._max_ch
+
+    # Length of the bitmap of a glyph of a given width
+    def _glen(self, width):
+        ht = self._height
+        if self._flags & _HMAP:
+            return ((width - 1) // 8 + 1) * ht
+        return ((ht - 1) // 8 + 1) * width
+
+    # Return offset of a glyph record relative to the start of glyph data.
+    # Absent chars return 0, the default char.
+    def _offset(self, oc):
+        f = self._f
+        if self._flags & _SPARSE:  # Binary search of sorted (ordinal, offset) entries
+            buf = self._mv8
+            lo = 0
+            hi = self._nentries - 1
+            while lo <= hi:
+                mid = (lo + hi) // 2
+                f.seek(self._index + mid * 8)
+                f.readinto(buf)
+                val = _u32(buf, 0)
+                if val == oc:
+                    return _u32(buf, 4)
+                if val < oc:
+                    lo = mid + 1
+                else:
+                    hi = mid - 1
+            return 0
+        if not self._min_ch <= oc <= self._max_ch:
+            return 0
+        buf = self._mv4
+        f.seek(self._index + (oc - self._min_ch + 1) * 4)  # Entry 0 is default char
+        f.readinto(buf)
+        return _u32(buf, 0)
+
+    # Return the width of a glyph without reading its bitmap
+    def get_width(self, ch):
+        if ch in self._slots:
+            return self._widths[self._slots[ch]]
+        f = self._f
+        f.seek(self._data + self._offset(ord(ch)))
+        f.readinto(self._mv2)
+        buf = self._mv2
+        return buf[0] | buf[1] << 8
+
+    def get_ch(self, ch):
+        self._tick += 1
+        slots = self._slots
+        if ch in slots:
+            self.hits += 1
+            slot = slots[ch]
+            self._used[slot] = self._tick
+            return (
+                self._bufs[slot][: self._lens[slot]],
+                self._height,
+                self._widths[slot],
+            )
+        self.misses += 1
+        # Evict the least recently used slot
+        used = self._used
+        slot = 0
+        for n in range(1, len(used)):
+            if used[n] < used[slot]:
+                slot = n
+        old = self._chars[slot]
+        if old is not None:
+            del slots[old]
+        f = self._f
+        f.seek(self._data + self._offset(ord(ch)))
+        f.readinto(self._mv2)
+        buf = self._mv2
+        width = buf[0] | buf[1] << 8
+        length = self._glen(width)
+        glyph = self._bufs[slot][:length]
+        f.readinto(glyph)
+        self._widths[slot] = width
+        self._lens[slot] = length
+        self._used[slot] = self._tick
+        self._chars[slot] = ch
+        slots[ch] = slot
+        return glyph, self._height, width
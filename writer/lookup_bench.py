@@ -0,0 +1,57 @@
+# lookup_bench.py Time glyph lookup in Python font files.
+
+# Released under the MIT License (MIT). See LICENSE.
+# Copyright (c) 2026 Peter Hinch
+
+# Compares fonts created with different --emitter or --index args, e.g.
+# font_to_py.py FreeSans.ttf 20 fs_bytecode.py
+# font_to_py.py FreeSans.ttf 20 fs_viper.py --emitter viper
+# Then on the target:
+# import lookup_bench
+# lookup_bench.test("fs_bytecode", "fs_viper")
+# Under CPython the bytecode lookup is always used, so only --index args can
+# usefully be compared.
+
+try:
+    from time import ticks_us, ticks_diff
+except ImportError:  # CPython
+    from time import perf_counter_ns
+
+    def ticks_us():
+        return perf_counter_ns() // 1000
+
+    def ticks_diff(end, start):
+        return end - start
+
+
+_TEXT = "The quick brown fox jumps over the lazy dog 0123456789"
+
+
+# Both functions are called directly with identical loop overhead.
+def _time_get_ch(get_ch, text, reps):
+    t = ticks_us()
+    for _ in range(reps):
+        for ch in text:
+            get_ch(ch)
+    return ticks_diff(ticks_us(), t) / (reps * len(text))
+
+
+def _time_lookup(lookup, text, reps):
+    res = [0, 0, 0]
+    t = ticks_us()
+    for _ in range(reps):
+        for ch in text:
+            lookup(ch, res)
+    return ticks_diff(ticks_us(), t) / (reps * len(text))
+
+
+# Print the time in μs of get_ch and lookup for each named font module. Fonts
+# created by older versions of font_to_py.py have no lookup.
+def test(*names, text=_TEXT, reps=20):
+    for name in names:
+        font = __import__(name)
+        get_ch = _time_get_ch(font.get_ch, text, reps)
+        st = "{:16s} get_ch {:7.2f}μs".format(name, get_ch)
+        if hasattr(font, "lookup"):
+            st += " lookup {:7.2f}μs".format(_time_lookup(font.lookup, text, reps))
+        print(st)
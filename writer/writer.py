@@ -1,6 +1,8 @@
 # writer.py Implements the Writer class.
 # Handles colour, word wrap and tab stops
 
+# V0.5.3 Oct 2026 Allocation-free rendering of fonts with lookup(). Support
+# cropped fonts. Measure text with get_width() and get_ink() where available.
 # V0.5.2 May 2025 Fix bug whereby glyph clipping might be attempted.
 # V0.5.1 Dec 2022 Support 4-bit color display drivers.
 # V0.5.0 Sep 2021 Color now requires firmware >= 1.17.
@@ -25,7 +27,7 @@
 import framebuf
 from uctypes import bytearray_at, addressof
 
-__version__ = (0, 5, 2)
+__version__ = (0, 5, 3)
 
 
 class DisplayState:
@@ -95,6 +97,22 @@ class Writer:
         self.glyph = None  # Current char
         self.char_height = 0
         self.char_width = 0
+        # Fonts created with --crop hold glyphs cropped to their ink box
+        self.crop = hasattr(font, "get_glyph")
+        self.box = None  # Ink box height, width and x, y offsets in char
+        # Fonts with lookup() are rendered without allocation: glyphs are
+        # located by integer offset into font_data() and copied into a single
+        # buffer whose FrameBuffers are cached by width.
+        self.lookup = hasattr(font, "lookup") and not self.crop
+        if self.lookup:
+            self._res = [0, 0, 0]  # Offset, width and length of current glyph
+            self._data = font.font_data()
+            self._buf = bytearray(((font.max_width() - 1) // 8 + 1) * font.height())
+            self._fbufs = {}  # FrameBuffers of ._buf keyed by width
+        # Fonts with get_width() are measured without accessing bitmaps
+        self.get_width = font.get_width if hasattr(font, "get_width") else None
+        # Fonts with get_ink() hold the ink extents of each glyph
+        self.get_ink = font.get_ink if hasattr(font, "get_ink") else None
 
     def _getstate(self):
         return Writer.state[self.devid]
@@ -160,30 +178,44 @@ class Writer:
         wd = self.screenwidth
         l = 0
         for char in string[:-1]:
-            _, _, char_width = self.font.get_ch(char)
-            l += char_width
+            l += self._width(char)
             if oh and l + sc > wd:
                 return True  # All done. Save time.
         char = string[-1]
-        _, _, char_width = self.font.get_ch(char)
+        char_width = self._width(char)
         if oh and l + sc + char_width > wd:
             l += self._truelen(char)  # Last char might have blank cols on RHS
         else:
             l += char_width  # Public method. Return same value as old code.
         return l + sc > wd if oh else l
 
+    def _width(self, char):
+        if self.get_width is not None:
+            return self.get_width(char)
+        if self.lookup:
+            return self.font.lookup(char, self._res)[1]
+        return self.font.get_ch(char)[2]
+
     # Return the printable width of a glyph less any blank columns on RHS
     def _truelen(self, char):
-        glyph, ht, wd = self.font.get_ch(char)
+        if self.get_ink is not None:  # As below, a blank glyph has length 1
+            return self.get_ink(char)[1] or 1
+        if self.lookup:
+            off, wd, _ = self.font.lookup(char, self._res)
+            glyph = self._data
+            ht = self.font.height()
+        else:
+            off = 0
+            glyph, ht, wd = self.font.get_ch(char)
         div, mod = divmod(wd, 8)
         gbytes = div + 1 if mod else div  # No. of bytes per row of glyph
         mc = 0  # Max non-blank column
-        data = glyph[(wd - 1) // 8]  # Last byte of row 0
+        data = glyph[off + (wd - 1) // 8]  # Last byte of row 0
         for row in range(ht):  # Glyph row
             for col in range(wd - 1, -1, -1):  # Glyph column
                 gbyte, gbit = divmod(col, 8)
                 if gbit == 0:  # Next glyph byte
-                    data = glyph[row * gbytes + gbyte]
+                    data = glyph[off + row * gbytes + gbyte]
                 if col <= mc:
                     break
                 if data & (1 << (7 - gbit)):  # Pixel is lit (1)
@@ -212,7 +244,15 @@ class Writer:
         if char == "\n":
             self._newline()
             return
-        glyph, char_height, char_width = self.font.get_ch(char)
+        if self.crop:
+            glyph, bh, bw, bx, by, char_width = self.font.get_glyph(char)
+            char_height = self.font.height()
+            self.box = (bh, bw, bx, by)
+        elif self.lookup:
+            glyph, char_width, _ = self.font.lookup(char, self._res)  # Offset
+            char_height = self.font.height()
+        else:
+            glyph, char_height, char_width = self.font.get_ch(char)
         s = self._getstate()
         if s.text_row + char_height > self.screenheight:
             if self.row_clip:
@@ -227,6 +267,52 @@ class Writer:
         self.char_height = char_height
         self.char_width = char_width
 
+    # Fonts with lookup(): return a FrameBuffer for the current glyph. These are
+    # cached by offset, or by width where glyphs are decoded into a buffer at
+    # offset 0.
+    # Return a FrameBuffer holding a copy of the current glyph, inverted if
+    # required.
+    def _fbuf(self, invert=False):
+        off, width, n = self._res
+        if n > len(self._buf):  # Glyphs may be wider than max_width()
+            self._buf = bytearray(n)
+            self._fbufs = {}
+        buf = self._buf
+        data = self._data
+        if invert:
+            for i in range(n):
+                buf[i] = 0xFF & ~data[off + i]
+        else:
+            for i in range(n):
+                buf[i] = data[off + i]
+        if width not in self._fbufs:
+            fbc = framebuf.FrameBuffer(buf, width, self.char_height, self.map)
+            self._fbufs[width] = fbc
+        return self._fbufs[width]
+
+    # Cropped glyphs: fill the parts of the char cell outside the ink box.
+    # Return the position of the box.
+    def _clear(self, color):
+        s = self._getstate()
+        x = s.text_col
+        y = s.text_row
+        w = self.char_width
+        h = self.char_height
+        bh, bw, bx, by = self.box
+        dev = self.device
+        if not bw:  # Blank glyph
+            dev.fill_rect(x, y, w, h, color)
+            return x, y
+        if by:
+            dev.fill_rect(x, y, w, by, color)
+        if by + bh < h:
+            dev.fill_rect(x, y + by + bh, w, h - by - bh, color)
+        if bx:
+            dev.fill_rect(x, y + by, bx, bh, color)
+        if bx + bw < w:
+            dev.fill_rect(x + bx + bw, y + by, w - bx - bw, bh, color)
+        return x + bx, y + by
+
     # Method using blitting. Efficient rendering for monochrome displays.
     # Tested on SSD1306. Invert is for black-on-white rendering.
     def _printchar(self, char, invert=False, recurse=False):
@@ -234,12 +320,25 @@ class Writer:
         self._get_char(char, recurse)
         if self.glyph is None:
             return  # All done
+        if self.lookup:
+            fbc = self._fbuf(invert)
+            self.device.blit(fbc, s.text_col, s.text_row)
+            s.text_col += self.char_width
+            self.cpos += 1
+            return
         buf = bytearray(self.glyph)
         if invert:
             for i, v in enumerate(buf):
                 buf[i] = 0xFF & ~v
-        fbc = framebuf.FrameBuffer(buf, self.char_width, self.char_height, self.map)
-        self.device.blit(fbc, s.text_col, s.text_row)
+        if self.crop:
+            x, y = self._clear(self.fgcolor if invert else self.bgcolor)
+            bh, bw, _, _ = self.box
+            if bw:
+                fbc = framebuf.FrameBuffer(buf, bw, bh, self.map)
+                self.device.blit(fbc, x, y)
+        else:
+            fbc = framebuf.FrameBuffer(buf, self.char_width, self.char_height, self.map)
+            self.device.blit(fbc, s.text_col, s.text_row)
         s.text_col += self.char_width
         self.cpos += 1
 
@@ -283,12 +382,24 @@ class CWriter(Writer):
         self._get_char(char, recurse)
         if self.glyph is None:
             return  # All done
-        buf = bytearray_at(addressof(self.glyph), len(self.glyph))
-        fbc = framebuf.FrameBuffer(buf, self.char_width, self.char_height, self.map)
-        palette = self.device.palette
-        palette.bg(self.fgcolor if invert else self.bgcolor)
-        palette.fg(self.bgcolor if invert else self.fgcolor)
-        self.device.blit(fbc, s.text_col, s.text_row, -1, palette)
+        bgcolor = self.fgcolor if invert else self.bgcolor
+        fgcolor = self.bgcolor if invert else self.fgcolor
+        if self.crop:
+            x, y = self._clear(bgcolor)
+            height, width, _, _ = self.box
+        else:
+            x, y = s.text_col, s.text_row
+            height, width = self.char_height, self.char_width
+        if width:
+            if self.lookup:
+                fbc = self._fbuf()
+            else:
+                buf = bytearray_at(addressof(self.glyph), len(self.glyph))
+                fbc = framebuf.FrameBuffer(buf, width, height, self.map)
+            palette = self.device.palette
+            palette.bg(bgcolor)
+            palette.fg(fgcolor)
+            self.device.blit(fbc, x, y, -1, palette)
         s.text_col += self.char_width
         self.cpos += 1
 